@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+# Measures the orchestration overhead of project.py without boards or a toolchain.
+# Stub tools (stub.py) stand in for cmake, make, ninja, picotool, openocd,
+# gdb-multiarch and wezterm, a simulated sysfs tree stands in for the USB bus.
+# Every run of project.py is timed end to end and its --trace output gives the
+# time per phase. 'tool busy' is the time during which at least one stub was
+# working, the rest of the wall time is overhead of project.py itself.
+
+STUB_TOOLS = ["cmake", "make", "ninja", "picotool", "openocd", "gdb-multiarch", "wezterm", "sudo", "killall"]
+DEFAULT_LATENCIES = {
+    "BENCH_CMAKE_LATENCY": "0.2",
+    "BENCH_MAKE_LATENCY": "0.5",
+    "BENCH_NINJA_LATENCY": "0.5",
+    "BENCH_PICOTOOL_REBOOT_LATENCY": "0.1",
+    "BENCH_PICOTOOL_LOAD_LATENCY": "0.5",
+    "BENCH_PICOTOOL_INFO_LATENCY": "0.05",
+    "BENCH_OPENOCD_LATENCY": "0.5",
+    "BENCH_USB_ENUM_DELAY": "0.5"}
+DEVICES_PER_HUB = 4
+PORT_BASE = 41000
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+def parse_setting(text, option):
+    if "=" not in text:
+        sys.exit("An error occurred: {v1} expects KEY=VALUE, got '{v2}'.".format(v1=option, v2=text))
+    return text.split("=", 1)
+
+def create_workspace(path, programs, devices, debug):
+    # sources, simulated sysfs, stub tools and config for programs x devices boards
+    for name in ("sdk", "sysfs", "dev", "bin", "state"):
+        os.makedirs("{v1}/{v2}".format(v1=path, v2=name))
+    config = {
+        "devices": [],
+        "programs": [],
+        "behaviour": "run",
+        "build_path": "{}/build".format(path),
+        "build_nproc": str(os.cpu_count() or 1),
+        "pico_sdk_path": "{}/sdk".format(path),
+        "gdb_debug": "on" if debug else "off",
+        "openocd_output": "off",
+        "picotool_listen": "on",
+        "root_pw": "benchmark"}
+    usb_index = 0
+    def add_device(name, serial):
+        nonlocal usb_index
+        #DEVICES_PER_HUB boards per hub, hubs on root bus 1
+        port = "1-{v1}.{v2}".format(v1=usb_index // DEVICES_PER_HUB + 1, v2=usb_index % DEVICES_PER_HUB + 1)
+        usb_index += 1
+        os.makedirs("{v1}/sysfs/{v2}".format(v1=path, v2=port))
+        for attr, value in (("idVendor", "2e8a"), ("idProduct", "000a"), ("serial", serial)):
+            with open("{v1}/sysfs/{v2}/{v3}".format(v1=path, v2=port, v3=attr), "w") as f:
+                f.write(value + "\n")
+        config["devices"].append({"name": name, "board": "pico", "serial": serial})
+
+    for i in range(programs):
+        src_path = "{v1}/src/p{v2}".format(v1=path, v2=i)
+        os.makedirs(src_path)
+        with open("{}/CMakeLists.txt".format(src_path), "w") as f:
+            f.write("cmake_minimum_required(VERSION 3.13)\nproject(p{})\n".format(i))
+        with open("{}/main.c".format(src_path), "w") as f:
+            f.write("int main() {{ return {}; }}\n".format(i))
+        with open("{}/gdb.txt".format(src_path), "w") as f:
+            f.write("")
+        device_names = []
+        for j in range(devices):
+            device_names.append("d{v1}_{v2}".format(v1=i, v2=j))
+            add_device(device_names[-1], "B{v1:03d}{v2:03d}".format(v1=i, v2=j))
+        program = {
+            "name": "p{}".format(i),
+            "build_type": "debug" if debug else "release",
+            "src_path": src_path,
+            "devices": device_names,
+            "debug_device_name": "",
+            "gdb_port": str(PORT_BASE + 3 * i),
+            "tcl_port": str(PORT_BASE + 3 * i + 1),
+            "telnet_port": str(PORT_BASE + 3 * i + 2),
+            "gdb_commands_path": "{}/gdb.txt".format(src_path)}
+        if debug:
+            add_device("probe{}".format(i), "P{:06d}".format(i))
+            program["debug_device_name"] = "probe{}".format(i)
+        config["programs"].append(program)
+
+    for tool in STUB_TOOLS:
+        wrapper_path = "{v1}/bin/{v2}".format(v1=path, v2=tool)
+        with open(wrapper_path, "w") as f:
+            f.write("#!/bin/sh\nexec {v1} {v2}/stub.py {v3} \"$@\"\n".format(v1=sys.executable, v2=script_dir, v3=tool))
+        os.chmod(wrapper_path, 0o755)
+    return config
+
+def stop_stub_processes(state_path):
+    # openocd stubs and panes keep running like the real ones, they go away after every run
+    try:
+        with open("{}/pids".format(state_path), 'r') as f:
+            pids = [int(line) for line in f if line.strip() != ""]
+    except OSError:
+        return
+    for pid in pids:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    os.remove("{}/pids".format(state_path))
+
+def busy_time(state_path, since):
+    # length of the union of all stub calls that started after 'since'
+    try:
+        with open("{}/calls.log".format(state_path), 'r') as f:
+            calls = [json.loads(line) for line in f]
+    except OSError:
+        return 0.0
+    intervals = sorted((c["start"], c["end"]) for c in calls if c["start"] >= since and c["tool"] not in ("sudo", "killall"))
+    total = 0.0
+    current_start, current_end = None, None
+    for start, end in intervals:
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+def run_project(path, project_args, env):
+    # one run of project.py, returns (wall seconds, return code, phase spans)
+    trace_path = "{}/trace.json".format(path)
+    if os.path.exists(trace_path):
+        os.remove(trace_path)
+    args = [sys.executable, "{}/project.py".format(path), "{}/config.json".format(path), "--ignore_stdout_warning", "--trace", trace_path] + project_args
+    start = time.monotonic()
+    with open("{}/project.log".format(path), "a") as log:
+        res = subprocess.run(args, input=b"stop\n", stdout=log, stderr=subprocess.STDOUT, env=env, cwd=path)
+    wall = time.monotonic() - start
+    spans = []
+    try:
+        with open(trace_path, 'r') as f:
+            spans = [e for e in json.load(f)["traceEvents"] if e["cat"] == "phase"]
+    except (OSError, ValueError):
+        pass
+    return wall, res.returncode, spans
+
+parser = argparse.ArgumentParser(description="Benchmark project.py against stub tools and simulated boards.")
+parser.add_argument("--programs", type=int, default=4, help="number of programs (default 4)")
+parser.add_argument("--devices", type=int, default=1, help="devices per program (default 1)")
+parser.add_argument("--runs", type=int, default=3, help="runs of project.py on the same workspace, the first one is cold (default 3)")
+parser.add_argument("--debug", action="store_true", help="start OpenOCD/GDB for every program, one probe each")
+parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="config setting, e.g. parallel_build=on")
+parser.add_argument("--latency", action="append", default=[], metavar="TOOL=SECONDS", help="stub latency, e.g. make=2 or picotool_load=1")
+parser.add_argument("--fail", action="append", default=[], metavar="TOOL=RATE", help="stub failure probability, e.g. picotool_load=0.1")
+parser.add_argument("--project", default="{}/../project_template/project.py".format(script_dir), help="project.py to measure")
+parser.add_argument("--project-args", default="", help="extra arguments for project.py, e.g. '--force-flash'")
+parser.add_argument("--max-overhead", type=float, default=None, help="exit with code 1 when the median overhead of the warm runs exceeds SECONDS")
+parser.add_argument("--json", default="", help="also write the results to this file")
+parser.add_argument("--keep", action="store_true", help="keep the workspace for inspection")
+options = parser.parse_args()
+
+workspace_path = tempfile.mkdtemp(prefix="project-bench-")
+config = create_workspace(workspace_path, options.programs, options.devices, options.debug)
+for setting in options.set:
+    key, value = parse_setting(setting, "--set")
+    config[key] = value
+with open("{}/config.json".format(workspace_path), "w") as f:
+    json.dump(config, f, indent=4)
+shutil.copy(options.project, "{}/project.py".format(workspace_path))
+
+env = os.environ.copy()
+for key, value in DEFAULT_LATENCIES.items():
+    env.setdefault(key, value)
+for option, suffix in ((options.latency, "LATENCY"), (options.fail, "FAIL")):
+    for setting in option:
+        tool, value = parse_setting(setting, "--" + suffix.lower())
+        env["BENCH_{v1}_{v2}".format(v1=tool.upper().replace("-", "_"), v2=suffix)] = value
+env["PATH"] = "{v1}/bin:{v2}".format(v1=workspace_path, v2=env.get("PATH", ""))
+env["BENCH_STATE"] = "{}/state".format(workspace_path)
+env["BENCH_SYSFS"] = "{}/sysfs".format(workspace_path)
+env["PICO_SYSFS_USB_PATH"] = env["BENCH_SYSFS"]
+env["PICO_DEV_PATH"] = "{}/dev".format(workspace_path)
+
+print("{v1} program(s) x {v2} device(s), {v3} run(s), workspace {v4}".format(v1=options.programs, v2=options.devices, v3=options.runs, v4=workspace_path))
+results = []
+try:
+    for run in range(options.runs):
+        run_start = time.time()
+        wall, return_code, spans = run_project(workspace_path, options.project_args.split(), env)
+        stop_stub_processes(env["BENCH_STATE"])
+        busy = busy_time(env["BENCH_STATE"], run_start)
+        results.append({"run": run + 1, "wall": wall, "tool_busy": busy, "overhead": max(0.0, wall - busy), "return_code": return_code, "spans": spans})
+finally:
+    stop_stub_processes(env["BENCH_STATE"])
+
+print("  {v1:>3} {v2:>9} {v3:>13} {v4:>12}  {v5}".format(v1="run", v2="wall [s]", v3="tool busy [s]", v4="overhead [s]", v5="result"))
+for result in results:
+    print("  {v1:>3} {v2:>9.2f} {v3:>13.2f} {v4:>12.2f}  {v5}".format(
+        v1=result["run"], v2=result["wall"], v3=result["tool_busy"], v4=result["overhead"],
+        v5="ok" if result["return_code"] == 0 else "failed ({})".format(result["return_code"])))
+
+#phase -> durations of every span over all runs
+phases = {}
+for result in results:
+    for span in result["spans"]:
+        phases.setdefault(span["name"], []).append(span["dur"] / 1000000)
+print("Phases over all runs:")
+print("  {v1} {v2:>6} {v3:>9} {v4:>8} {v5:>8}".format(v1="phase".ljust(22), v2="spans", v3="total [s]", v4="mean [s]", v5="max [s]"))
+for name, durations in sorted(phases.items(), key=lambda item: sum(item[1]), reverse=True):
+    print("  {v1} {v2:>6} {v3:>9.2f} {v4:>8.2f} {v5:>8.2f}".format(v1=name.ljust(22), v2=len(durations), v3=sum(durations), v4=sum(durations) / len(durations), v5=max(durations)))
+
+if options.json != "":
+    with open(options.json, "w") as f:
+        json.dump({"programs": options.programs, "devices": options.devices, "config": {k: v for k, v in config.items() if k not in ("devices", "programs")}, "runs": results}, f, indent=4)
+if not options.keep:
+    shutil.rmtree(workspace_path, ignore_errors=True)
+else:
+    print("Workspace kept in {}".format(workspace_path))
+
+exit_code = 0
+if any(result["return_code"] != 0 for result in results):
+    print("project.py failed, see project.log in the workspace (--keep).")
+    exit_code = 1
+warm_overheads = sorted(result["overhead"] for result in results[1:])
+if options.max_overhead is not None and len(warm_overheads) > 0:
+    median_overhead = warm_overheads[len(warm_overheads) // 2]
+    if median_overhead > options.max_overhead:
+        print("Median overhead of the warm runs {v1:.2f} s exceeds {v2:.2f} s.".format(v1=median_overhead, v2=options.max_overhead))
+        exit_code = 1
+sys.exit(exit_code)
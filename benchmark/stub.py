@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+# Stand-in for cmake, make, ninja, picotool, openocd, gdb-multiarch, wezterm,
+# sudo and killall. bench.py puts one wrapper per tool on PATH which runs
+# 'python3 stub.py <tool> <args>'. Every call sleeps for its configured latency,
+# fails with its configured probability and is logged to BENCH_STATE/calls.log.
+#
+# BENCH_<TOOL>[_<SUBCOMMAND>]_LATENCY - seconds, e.g. BENCH_PICOTOOL_LOAD_LATENCY
+# BENCH_<TOOL>[_<SUBCOMMAND>]_FAIL    - failure probability 0..1
+# BENCH_USB_ENUM_DELAY               - seconds until a rebooted device shows up again
+# BENCH_SYSFS                        - simulated /sys/bus/usb/devices tree
+
+BOOTSEL_PRODUCT_ID = "0003"
+APP_PRODUCT_ID = "000a"
+
+def env_setting(tool, subcommand, name, default):
+    keys = ["BENCH_{v1}_{v2}".format(v1=tool, v2=name)]
+    if subcommand != "":
+        keys.insert(0, "BENCH_{v1}_{v2}_{v3}".format(v1=tool, v2=subcommand.upper().replace("-", "_"), v3=name))
+    for key in keys:
+        if key in os.environ:
+            return float(os.environ[key])
+    return default
+
+def log_call(state_path, record):
+    with open("{}/calls.log".format(state_path), "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+def arg_value(args, name, default=""):
+    if name in args and args.index(name) + 1 < len(args):
+        return args[args.index(name) + 1]
+    return default
+
+def find_sysfs_device(serial):
+    sysfs_path = os.environ["BENCH_SYSFS"]
+    for entry in os.listdir(sysfs_path):
+        try:
+            with open("{v1}/{v2}/serial".format(v1=sysfs_path, v2=entry), 'r') as f:
+                if f.read().strip() == serial:
+                    return "{v1}/{v2}".format(v1=sysfs_path, v2=entry)
+        except OSError:
+            continue
+    return None
+
+def set_product_later(serial, product, delay):
+    # the device re-enumerates after the command has returned, like a real board
+    device_path = find_sysfs_device(serial)
+    if device_path is None:
+        return
+    if os.fork() != 0:
+        return
+    os.setsid()
+    #the caller reads our stdout until every writer is gone, the child must not hold it
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    time.sleep(delay)
+    with open("{}/idProduct".format(device_path), "w") as f:
+        f.write(product + "\n")
+    os._exit(0)
+
+def write_image(build_dir, name):
+    # deterministic output, so unchanged sources produce an unchanged image
+    with open("{}/CMakeCache.txt".format(build_dir), 'r') as f:
+        src_path = re.search(r"CMAKE_HOME_DIRECTORY:INTERNAL=(.*)", f.read()).group(1)
+    digest = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(src_path)):
+        for file_name in sorted(files):
+            with open(os.path.join(root, file_name), 'rb') as f:
+                digest.update(f.read())
+    for extension in (".uf2", ".elf"):
+        with open("{v1}/{v2}{v3}".format(v1=build_dir, v2=name, v3=extension), "wb") as f:
+            f.write(digest.digest() * 512)
+
+def run_cmake(args):
+    build_dir = arg_value(args, "-B")
+    if build_dir == "":
+        return 0
+    os.makedirs(build_dir, exist_ok=True)
+    generator = "Ninja" if arg_value(args, "-G") == "Ninja" else "Unix Makefiles"
+    with open("{}/CMakeCache.txt".format(build_dir), "w") as f:
+        f.write("CMAKE_HOME_DIRECTORY:INTERNAL={}\n".format(os.path.abspath(arg_value(args, "-S"))))
+        f.write("CMAKE_GENERATOR:INTERNAL={}\n".format(generator))
+    return 0
+
+def run_build(args):
+    if "--version" in args:
+        print("1.13.0")
+        return 0
+    build_dir = arg_value(args, "-C")
+    if "-t" in args:
+        return 0
+    write_image(build_dir, os.path.basename(build_dir.rstrip("/")))
+    return 0
+
+def read_product(serial):
+    device_path = find_sysfs_device(serial)
+    if device_path is None:
+        return None
+    with open("{}/idProduct".format(device_path), 'r') as f:
+        return f.read().strip()
+
+def run_picotool(args):
+    # like picotool: 'reboot' without -u returns to the application, 'load' without -x
+    # leaves a board in BOOTSEL unless -f had to force it there
+    serial = arg_value(args, "--ser")
+    enum_delay = float(os.environ.get("BENCH_USB_ENUM_DELAY", "0.5"))
+    if args[0] == "reboot":
+        set_product_later(serial, BOOTSEL_PRODUCT_ID if "-u" in args else APP_PRODUCT_ID, enum_delay)
+    elif args[0] == "load":
+        if "-x" in args or read_product(serial) != BOOTSEL_PRODUCT_ID:
+            set_product_later(serial, APP_PRODUCT_ID, enum_delay)
+    elif args[0] == "info":
+        return 0 if read_product(serial) == BOOTSEL_PRODUCT_ID else 1
+    return 0
+
+def run_openocd(args, state_path):
+    # listens on the tcl and gdb ports of its config until bench.py stops it
+    with open(arg_value(args, "-f"), 'r') as f:
+        config_text = f.read()
+    with open("{}/pids".format(state_path), "a") as f:
+        f.write("{}\n".format(os.getpid()))
+    listeners = []
+    for name in ("tcl_port", "gdb_port"):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("localhost", int(re.search(name + r" (\d+)", config_text).group(1))))
+        listener.listen()
+        listeners.append(listener)
+    def serve(listener):
+        while True:
+            connection, _ = listener.accept()
+            if connection.recv(256):
+                connection.sendall(b"Open On-Chip Debugger (benchmark stub)\x1a")
+            connection.close()
+    threading.Thread(target=serve, args=(listeners[1],), daemon=True).start()
+    serve(listeners[0])
+
+def run_wezterm(args, state_path):
+    if args[:2] != ["cli", "spawn"]:
+        return 0
+    command = args[args.index("--") + 1:]
+    with open("{}/panes.log".format(state_path), "a") as log:
+        pane = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+    with open("{}/pids".format(state_path), "a") as f:
+        f.write("{}\n".format(pane.pid))
+    print(pane.pid)
+    return 0
+
+tool = sys.argv[1]
+args = sys.argv[2:]
+state_path = os.environ["BENCH_STATE"]
+
+if tool == "sudo":
+    #the password arrives on stdin with -S
+    if len(args) > 0 and args[0] == "-S":
+        args = args[1:]
+        sys.stdin.readline()
+    os.execvp(args[0], args)
+
+tool_key = tool.upper().replace("-", "_")
+subcommand = ""
+if tool in ("picotool", "wezterm") and len(args) > 0:
+    subcommand = args[0] if tool == "picotool" else " ".join(args[:2])
+latency = env_setting(tool_key, subcommand.replace(" ", "_"), "LATENCY", 0.0)
+fail_rate = env_setting(tool_key, subcommand.replace(" ", "_"), "FAIL", 0.0)
+
+start = time.time()
+if tool == "openocd":
+    #the interval logged for openocd is its start-up, it keeps running afterwards
+    time.sleep(latency)
+    log_call(state_path, {"tool": tool, "subcommand": subcommand, "start": start, "end": time.time(), "failed": False})
+    if random.random() < fail_rate:
+        print("benchmark stub: injected failure", file=sys.stderr)
+        sys.exit(1)
+    run_openocd(args, state_path)
+
+time.sleep(latency)
+failed = (random.random() < fail_rate)
+return_code = 1
+if failed:
+    print("benchmark stub: injected failure", file=sys.stderr)
+elif tool == "cmake":
+    return_code = run_cmake(args)
+elif tool in ("make", "ninja"):
+    return_code = run_build(args)
+elif tool == "picotool":
+    return_code = run_picotool(args)
+elif tool == "wezterm":
+    return_code = run_wezterm(args, state_path)
+else:
+    #gdb-multiarch, killall: nothing to simulate beyond the latency
+    return_code = 0
+log_call(state_path, {"tool": tool, "subcommand": subcommand, "start": start, "end": time.time(), "failed": failed})
+sys.exit(return_code)
@@ -0,0 +1,110 @@
+import json
+import os
+import sys
+
+# Lists connected Raspberry Pi RP2 devices with their serial numbers in one sysfs
+# scan, in application and in BOOTSEL mode, no print_serial image is needed.
+#
+# python3 discover.py [--json] [config.json]
+#   --json       also print "devices" entries ready to paste into config.json
+#   config.json  mark the devices which are already configured and leave them out of --json
+
+SYSFS_USB_PATH = os.environ.get("PICO_SYSFS_USB_PATH", "/sys/bus/usb/devices")
+RPI_VENDOR_ID = "2e8a"
+#product id -> (family, mode)
+RPI_PRODUCTS = {
+    "0003": ("RP2040", "bootsel"),
+    "000a": ("RP2040", "application"),
+    "0004": ("RP2040", "picoprobe"),
+    "000c": ("RP2040", "debug probe"),
+    "000f": ("RP2350", "bootsel"),
+    "0009": ("RP2350", "application")}
+#board used for the generated config entries, pico_w/pico2_w have to be set by hand
+FAMILY_BOARDS = {"RP2040": "pico", "RP2350": "pico2"}
+
+def read_sysfs_attr(path, name):
+    try:
+        with open("{v1}/{v2}".format(v1=path, v2=name), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+def find_usb_tty(port):
+    # CDC tty node of a device, interfaces are listed as <port>:<config>.<interface>
+    for entry in sorted(os.listdir(SYSFS_USB_PATH)):
+        if not entry.startswith(port + ":"):
+            continue
+        try:
+            ttys = os.listdir("{v1}/{v2}/tty".format(v1=SYSFS_USB_PATH, v2=entry))
+        except OSError:
+            continue
+        if len(ttys) > 0:
+            return ttys[0]
+    return ""
+
+def scan_devices():
+    devices = []
+    for entry in sorted(os.listdir(SYSFS_USB_PATH)):
+        #skip interfaces (1-2:1.0) and root hubs (usb1)
+        if ":" in entry or entry.startswith("usb"):
+            continue
+        path = "{v1}/{v2}".format(v1=SYSFS_USB_PATH, v2=entry)
+        if read_sysfs_attr(path, "idVendor") != RPI_VENDOR_ID:
+            continue
+        product = read_sysfs_attr(path, "idProduct")
+        family, mode = RPI_PRODUCTS.get(product, ("unknown", "product {}".format(product)))
+        devices.append({
+            "serial": read_sysfs_attr(path, "serial").upper(),
+            "family": family,
+            "mode": mode,
+            "port": entry,
+            "tty": find_usb_tty(entry)})
+    return devices
+
+emit_json = False
+config_path = ""
+for arg in sys.argv[1:]:
+    if arg == "--json":
+        emit_json = True
+    elif arg.startswith("-"):
+        print("An error occurred: unknown argument '{}'.".format(arg))
+        sys.exit(1)
+    else:
+        config_path = arg
+
+if not os.path.isdir(SYSFS_USB_PATH):
+    print("An error occurred: {} not found, USB devices can't be listed.".format(SYSFS_USB_PATH))
+    sys.exit(1)
+
+#serial -> device name of an existing config
+configured = {}
+if config_path != "":
+    try:
+        with open(config_path, 'r') as f:
+            configured = {d["serial"].upper(): d["name"] for d in json.load(f).get("devices", [])}
+    except (OSError, ValueError, KeyError) as e:
+        print("An error occurred: {}".format(e))
+        sys.exit(1)
+
+devices = scan_devices()
+if len(devices) == 0:
+    print("No Raspberry Pi USB devices found.")
+    sys.exit(0)
+print("{v1} {v2} {v3} {v4} {v5} {v6}".format(v1="SERIAL".ljust(18), v2="FAMILY".ljust(8), v3="MODE".ljust(13), v4="PORT".ljust(10), v5="TTY".ljust(10), v6="CONFIG"))
+for device in devices:
+    tty_path = "/dev/{}".format(device["tty"]) if device["tty"] != "" else "-"
+    print("{v1} {v2} {v3} {v4} {v5} {v6}".format(v1=(device["serial"] or "-").ljust(18), v2=device["family"].ljust(8), v3=device["mode"].ljust(13), v4=device["port"].ljust(10), v5=tty_path.ljust(10), v6=configured.get(device["serial"], "")))
+if any(device["mode"] == "bootsel" for device in devices):
+    print("NOTICE: devices in BOOTSEL mode report the same serial as the application they will run.")
+
+if emit_json:
+    entries = []
+    for device in devices:
+        if device["serial"] == "" or device["serial"] in configured or device["family"] not in FAMILY_BOARDS:
+            continue
+        #debug probes are listed as well, they are referenced through debug_device_name
+        prefix = "probe" if device["mode"] in ("debug probe", "picoprobe") else "pico"
+        entries.append({"name": "{v1}_{v2}".format(v1=prefix, v2=device["serial"][-4:].lower()), "board": FAMILY_BOARDS[device["family"]], "serial": device["serial"]})
+    print('"devices": [')
+    print(",\n".join("    {}".format(json.dumps(entry)) for entry in entries))
+    print("]")
@@ -1,44 +1,163 @@
 #!/usr/bin/python
 
 # .-------------------------------------------------------------------------.
-# | This program monitors for changes in 'lusb' reports and files in the    |
-# | /dev directory when a USB device is connected or removed. It basically  |
-# | saves having to manually run 'lsusb' and 'ls' and having to compare the |
-# | results.                                                                |
+# | This program monitors for USB devices and their /dev entries being      |
+# | connected or removed. It basically saves having to manually run 'lsusb' |
+# | and 'ls' and having to compare the results.                             |
+# |                                                                         |
+# | Kernel uevents are read from a netlink socket, so every add and remove  |
+# | is reported as it happens. Where netlink is not available (or with      |
+# | --poll) sysfs and /dev are polled once a second instead.                |
 # `-------------------------------------------------------------------------'
 
+import errno
 import os
+import socket
+import sys
 import time
 
-def GetUsbList() : return os.popen("lsusb").read().strip().split("\n")
-def GetDevList() : return os.listdir("/dev")
+SYSFS_USB = "/sys/bus/usb/devices"
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+UEVENT_RCVBUF = 4 * 1024 * 1024
+
+def ReadAttr(path, name):
+  try:
+    with open(os.path.join(path, name)) as f : return f.read().strip()
+  except OSError:
+    return ""
+
+def UsbAttrs(path):
+  return { "vendor"  : ReadAttr(path, "idVendor"),
+           "product" : ReadAttr(path, "idProduct"),
+           "name"    : ReadAttr(path, "product"),
+           "serial"  : ReadAttr(path, "serial") }
+
+def UsbText(port, attrs):
+  text = "usb " + port + " " + attrs["vendor"] + ":" + attrs["product"]
+  if attrs["name"]   : text += " " + attrs["name"]
+  if attrs["serial"] : text += " serial " + attrs["serial"]
+  return text
+
+def GetUsbDevices():
+  # port -> attributes, interfaces (1-2:1.0) and root hubs (usb1) left out
+  devices = {}
+  if not os.path.isdir(SYSFS_USB) : return devices
+  for port in os.listdir(SYSFS_USB):
+    if ":" in port or port.startswith("usb") : continue
+    devices[port] = UsbAttrs(os.path.join(SYSFS_USB, port))
+  return devices
+
+def GetDevList() : return set(os.listdir("/dev"))
 
 def Changed(old, now):
-  add = []
-  rem = []
-  for this in now:
-    if not this in old:
-      add.append(this)
-  for this in old:
-    if not this in now:
-      rem.append(this)
-  return add, rem
+  return now - old, old - now
 
-try:
-  print("Monitoring for USB changes and changes in /dev directory")
-  usbOld, devOld = GetUsbList(), GetDevList()
+def Report(kind, text):
+  print(time.strftime("%Y-%m-%d %H:%M:%S - ") + kind + " : " + text)
+
+def Poll():
+  print("Monitoring for USB changes and changes in /dev directory (polling)")
+  usbOld, devOld = GetUsbDevices(), GetDevList()
   while True:
     time.sleep(1)
-    usbNow, devNow = GetUsbList(), GetDevList()
-    usbAdd, usbRem = Changed(usbOld, usbNow)
+    usbNow, devNow = GetUsbDevices(), GetDevList()
+    usbAdd, usbRem = Changed(set(usbOld), set(usbNow))
     devAdd, devRem = Changed(devOld, devNow)
     if len(usbAdd) + len(usbRem) + len(devAdd) + len(devRem) > 0:
       print("-------------------")
-      t = time.strftime("%Y-%m-%d %H:%M:%S - ")
-      for this in usbAdd : print(t + "Added   : "      + this)
-      for this in usbRem : print(t + "Removed : "      + this)
-      for this in devAdd : print(t + "Added   : /dev/" + this)
-      for this in devRem : print(t + "Removed : /dev/" + this)
-      usbOld, devOld = usbNow, devNow
+      for this in sorted(usbAdd) : Report("Added  ", UsbText(this, usbNow[this]))
+      for this in sorted(usbRem) : Report("Removed", UsbText(this, usbOld[this]))
+      for this in sorted(devAdd) : Report("Added  ", "/dev/" + this)
+      for this in sorted(devRem) : Report("Removed", "/dev/" + this)
+    usbOld, devOld = usbNow, devNow
+
+def ParseUevent(data):
+  # "ACTION@DEVPATH\0KEY=VALUE\0..." from the kernel, libudev messages have no '@'
+  fields = data.split(b"\0")
+  if b"@" not in fields[0] : return None
+  event = {}
+  for field in fields[1:]:
+    key, sep, value = field.decode("utf-8", "replace").partition("=")
+    if sep : event[key] = value
+  return event
+
+def UsbPort(devpath):
+  # last path component that names a USB device, e.g. 1-1.2 for .../1-1.2/1-1.2:1.0/tty/ttyACM0
+  port = ""
+  for part in devpath.split("/"):
+    if part[:1].isdigit() and "-" in part and ":" not in part : port = part
+  return port
+
+def Resync(known, devs):
+  # uevents were dropped, sysfs and /dev tell what changed in the meantime
+  usbNow, devNow = GetUsbDevices(), GetDevList()
+  usbAdd, usbRem = Changed(set(known), set(usbNow))
+  devAdd, devRem = Changed(devs, devNow)
+  for this in sorted(usbAdd) : Report("Added  ", UsbText(this, usbNow[this]))
+  for this in sorted(usbRem) : Report("Removed", UsbText(this, known[this]))
+  for this in sorted(devAdd) : Report("Added  ", "/dev/" + this)
+  for this in sorted(devRem) : Report("Removed", "/dev/" + this)
+  return usbNow, devNow
+
+def Listen(sock):
+  print("Monitoring for USB changes and changes in /dev directory (uevents)")
+  # attributes are gone from sysfs once a device is removed, so they are remembered
+  known, devs = GetUsbDevices(), GetDevList()
+  while True:
+    try:
+      data = sock.recv(65536)
+    except OSError as e:
+      if e.errno != errno.ENOBUFS : raise
+      #a burst, e.g. a full hub enumerating, overflowed the socket buffer
+      print("-------------------")
+      print(time.strftime("%Y-%m-%d %H:%M:%S - ") + "Events were lost, rescanning USB devices and /dev")
+      known, devs = Resync(known, devs)
+      continue
+    event = ParseUevent(data)
+    if event is None : continue
+    action, devpath = event.get("ACTION"), event.get("DEVPATH", "")
+    if action not in ("add", "remove") : continue
+    kind = "Added  " if action == "add" else "Removed"
+    if event.get("SUBSYSTEM") == "usb" and event.get("DEVTYPE") == "usb_device":
+      port = os.path.basename(devpath)
+      if action == "add":
+        known[port] = UsbAttrs("/sys" + devpath)
+        Report(kind, UsbText(port, known[port]))
+      else:
+        attrs = known.pop(port, None)
+        if attrs is None:
+          #PRODUCT=vendor/product/bcdDevice in hex without leading zeros
+          ids = event.get("PRODUCT", "0/0/0").split("/")
+          attrs = { "vendor" : ids[0].zfill(4), "product" : ids[1].zfill(4), "name" : "", "serial" : "" }
+        Report(kind, UsbText(port, attrs))
+    elif "DEVNAME" in event:
+      #GetDevList() sees the top level of /dev only, bus/usb/... stays out
+      if "/" not in event["DEVNAME"]:
+        if action == "add" : devs.add(event["DEVNAME"])
+        else               : devs.discard(event["DEVNAME"])
+      text = "/dev/" + event["DEVNAME"]
+      port = UsbPort(devpath)
+      if port : text += " (usb " + port + ")"
+      Report(kind, text)
+
+try:
+  sock = None
+  if "--poll" not in sys.argv[1:]:
+    try:
+      sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+      # SO_RCVBUFFORCE goes beyond rmem_max but needs root
+      try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUFFORCE, UEVENT_RCVBUF)
+      except (OSError, AttributeError):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UEVENT_RCVBUF)
+      sock.bind((0, UEVENT_KERNEL_GROUP))
+    except (OSError, AttributeError) as e:
+      print("Netlink uevents are not available (" + str(e) + "), falling back to polling")
+      sock = None
+  if sock is None:
+    Poll()
+  else:
+    Listen(sock)
 except KeyboardInterrupt:
   print("")
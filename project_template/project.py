@@ -1,9 +1,28 @@
 import json
+import hashlib
 import sys
 import subprocess
 import os
 import time
 import socket
+import re
+import select
+import termios
+import tty
+import threading
+import asyncio
+import contextvars
+import atexit
+import sqlite3
+import concurrent.futures
+import collections
+import selectors
+import queue
+import shutil
+import uuid
+import tempfile
+import ctypes
+import struct
 
 BOARD_TYPES = {"pico", "pico_w", "pico2", "pico2_w"}
 BUILD_TYPES = {"debug", "release"}
@@ -11,10 +30,55 @@ BEHAVIOUR_TYPES = {"run", "build_only"}
 GDB_DEBUG = {"on", "off"}
 PICOTOOL_LISTEN = {"on", "off"}
 OPENOCD_OUTPUT = {"on", "off"}
+PARALLEL_BUILD = {"on", "off"}
+PIPELINE = {"on", "off"}
+SERIAL_LOG = {"on", "off"}
+GENERATORS = {"make", "ninja"}
+CCACHE = {"on", "off"}
+CCACHE_HIT_COUNTERS = {"direct_cache_hit", "preprocessed_cache_hit"}
+CCACHE_MISS_COUNTERS = {"cache_miss"}
+PICOTOOL_CMAKE_DIRS = ["/usr/local/lib/cmake/picotool", "/usr/local/lib64/cmake/picotool", "/usr/lib/cmake/picotool"]
 
 PICO_RELOAD_TIMEOUT = 10
 PICOTOOL_LOAD_TIMEOUT = 10
-OPENOCD_INIT_TIMEOUT = 5
+OPENOCD_INIT_TIMEOUT = 30
+
+#both can be pointed elsewhere, the benchmark runs against a simulated USB tree
+SYSFS_USB_PATH = os.environ.get("PICO_SYSFS_USB_PATH", "/sys/bus/usb/devices")
+DEV_PATH = os.environ.get("PICO_DEV_PATH", "/dev")
+RPI_VENDOR_ID = "2e8a"
+BOOTSEL_PRODUCT_IDS = {"0003", "000f"} #rp2040, rp2350
+USB_POLL_INTERVAL = 0.05
+PICOTOOL_POLL_INTERVAL = 0.25
+OPENOCD_POLL_INTERVAL = 0.1
+WATCH_DEBOUNCE = 0.5
+CONTROL_COMMANDS = {"build", "flash", "restart-debug", "status", "stop", "log"}
+TRACE_SUMMARY_SPANS = 10
+HISTORY_BASELINE_RUNS = 10
+HISTORY_RECENT_RUNS = 5
+HISTORY_REGRESSION_PHASES = {"configure", "build", "flash"}
+HISTORY_TIME_FACTOR = 1.25
+HISTORY_TIME_MIN_DELTA = 0.5
+HISTORY_SIZE_FACTOR = 1.02
+WATCH_POLL_INTERVAL = 1.0
+SERIAL_LOG_RING_LINES = 10000
+SERIAL_LOG_TAIL_LINES = 50
+SERIAL_LOG_LIVE_CHUNKS = 1024
+SERIAL_LOG_MAX_BYTES = 16 * 1024 * 1024
+SERIAL_LOG_BACKUPS = 3
+SERIAL_LOG_READ_SIZE = 65536
+SERIAL_LOG_RESCAN_INTERVAL = 1.0
+SERIAL_LOG_FLUSH_INTERVAL = 1.0
+
+#inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_EVENTS = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
 
 def send_gdb_command_remote(gdb_port, cmd):
     try:
@@ -27,25 +91,886 @@ def send_gdb_command_remote(gdb_port, cmd):
         print(f"Failed to connect to GDB on port {gdb_port}: {e}")
         return False
 
+def openocd_ready(tcl_port, gdb_port):
+    # OpenOCD answers on its tcl port only once init (and the 'program' step of
+    # its config) is done, so a round-trip there means GDB can attach.
+    # The gdb port is only probed for a connection when there is no tcl port.
+    try:
+        if tcl_port != "":
+            with socket.create_connection(('localhost', int(tcl_port)), timeout=0.5) as s:
+                s.sendall(b"version\x1a")
+                return s.recv(256) != b""
+        with socket.create_connection(('localhost', int(gdb_port)), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+#spans of this run as Chrome trace events, written to a file with --trace
+trace_events = []
+trace_events_lock = threading.Lock()
+trace_start = time.monotonic()
+#program and device the current thread works on, attached to every span it records
+trace_context = contextvars.ContextVar("trace_context", default={})
+
+def record_span(name, category, start, end, attrs=None):
+    args = dict(trace_context.get())
+    args.update(attrs or {})
+    with trace_events_lock:
+        trace_events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": int((start - trace_start) * 1000000),
+            "dur": int((end - start) * 1000000),
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": args})
+
+class TraceSpan:
+    # records the time spent in a 'with' block, attrs may still be set inside it
+    def __init__(self, name, category="phase", **attrs):
+        self.name = name
+        self.category = category
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["failed"] = True
+        record_span(self.name, self.category, self.start, time.monotonic(), self.attrs)
+        return False
+
+def write_trace(path):
+    # writes the trace for chrome://tracing or Perfetto and prints the slowest phases
+    with trace_events_lock:
+        events = list(trace_events)
+    try:
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    except OSError as e:
+        print("An error occurred: trace could not be written: {}".format(e))
+        return
+    print("Trace with {v1} spans written to {v2}".format(v1=len(events), v2=path))
+    phases = sorted((e for e in events if e["cat"] == "phase"), key=lambda e: e["dur"], reverse=True)
+    if len(phases) > 0:
+        print("Slowest phases:")
+    for e in phases[:TRACE_SUMMARY_SPANS]:
+        attrs = " ".join("{v1}={v2}".format(v1=k, v2=v) for k, v in e["args"].items())
+        print("  {v1:8.2f} s  {v2} {v3}".format(v1=e["dur"] / 1000000, v2=e["name"].ljust(20), v3=attrs))
+
+def open_history(path):
+    db = sqlite3.connect(path)
+    db.executescript(
+        "CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started_at TEXT, duration REAL, sdk_revision TEXT, toolchain_version TEXT, result TEXT);"
+        "CREATE TABLE IF NOT EXISTS phases (run_id INTEGER, program TEXT, device TEXT, phase TEXT, duration REAL, skipped INTEGER, failed INTEGER);"
+        "CREATE TABLE IF NOT EXISTS builds (run_id INTEGER, program TEXT, image_size INTEGER, ccache_hits INTEGER, ccache_misses INTEGER, artifact_cache_hit INTEGER);"
+        "CREATE TABLE IF NOT EXISTS flashes (run_id INTEGER, program TEXT, device TEXT, status TEXT);")
+    return db
+
+#trace_events up to this index are in the history already. With --trace the trace keeps all of
+#them, without it they are dropped once stored, so a long watch/daemon session doesn't grow
+history_recorded = 0
+history_first_run = True
+
+def record_history(path):
+    # appends the phases, builds and flash results recorded since the last call to the history
+    # database as one run: the first pass, then every watch rebuild and control command
+    global history_recorded, history_first_run
+    with trace_events_lock:
+        events = [e for e in trace_events[history_recorded:] if e["cat"] == "phase"]
+        first_run = history_first_run
+        history_first_run = False
+        if trace_path is None:
+            del trace_events[:]
+            history_recorded = 0
+        else:
+            history_recorded = len(trace_events)
+    if len(events) == 0:
+        return
+    failed = any(e["args"].get("failed", False) for e in events)
+    #the first run also counts the setup before its first span, later ones start with their first span
+    run_start = trace_start
+    if not first_run:
+        run_start = trace_start + min(e["ts"] for e in events) / 1000000
+    started_at = time.time() - (time.monotonic() - run_start)
+    builds = {}
+    try:
+        db = open_history(path)
+        with db:
+            run_id = db.execute("INSERT INTO runs (started_at, duration, sdk_revision, toolchain_version, result) VALUES (?, ?, ?, ?, ?)", (
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started_at)), time.monotonic() - run_start,
+                sdk_revision, toolchain_version, "failed" if failed else "ok")).lastrowid
+            for e in events:
+                args = e["args"]
+                skipped = args.get("skipped", False) or args.get("status") == "skipped"
+                db.execute("INSERT INTO phases (run_id, program, device, phase, duration, skipped, failed) VALUES (?, ?, ?, ?, ?, ?, ?)", (
+                    run_id, args.get("program", ""), args.get("device", ""), e["name"], e["dur"] / 1000000, int(skipped), int(args.get("failed", False))))
+                build = builds.setdefault(args.get("program", ""), {})
+                if e["name"] == "stage":
+                    build["image_size"] = args["image_size"]
+                elif e["name"] == "build" and "ccache_hits" in args:
+                    build["ccache_hits"] = args["ccache_hits"]
+                    build["ccache_misses"] = args["ccache_misses"]
+                elif e["name"] == "artifact cache lookup":
+                    build["artifact_cache_hit"] = int(args.get("hit", False))
+                elif e["name"] == "flash":
+                    db.execute("INSERT INTO flashes (run_id, program, device, status) VALUES (?, ?, ?, ?)", (
+                        run_id, args.get("program", ""), args.get("device", ""), "failed" if args.get("failed", False) else args.get("status", "")))
+            for program, build in builds.items():
+                if "image_size" in build:
+                    db.execute("INSERT INTO builds (run_id, program, image_size, ccache_hits, ccache_misses, artifact_cache_hit) VALUES (?, ?, ?, ?, ?, ?)", (
+                        run_id, program, build["image_size"], build.get("ccache_hits"), build.get("ccache_misses"), build.get("artifact_cache_hit")))
+        db.close()
+    except sqlite3.Error as e:
+        print("An error occurred: run history could not be written: {}".format(e))
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p / 100 * (len(values) - 1)))]
+
+def print_history_report(path):
+    # p50/p95 per program and phase over all runs, the last run against the median of the runs before it
+    if not os.path.isfile(path):
+        err("An error occurred: no run history in {}.".format(path))
+    db = open_history(path)
+    runs = db.execute("SELECT id, started_at, duration, sdk_revision, toolchain_version, result FROM runs ORDER BY id").fetchall()
+    if len(runs) == 0:
+        err("An error occurred: no run history in {}.".format(path))
+    last_run = runs[-1]
+    run_ids = [run[0] for run in runs]
+    baseline_ids = run_ids[-1 - HISTORY_BASELINE_RUNS:-1]
+    print("{v1} run(s) in {v2}, last run {v3}: {v4:.1f} seconds, {v5}".format(v1=len(runs), v2=path, v3=last_run[1], v4=last_run[2], v5=last_run[5]))
+    if len(runs) > 1 and runs[-2][3] != last_run[3]:
+        print("NOTICE: pico SDK revision changed in the last run.")
+    if len(runs) > 1 and runs[-2][4] != last_run[4]:
+        print("NOTICE: toolchain version changed in the last run.")
+
+    #(program, phase) -> run id -> seconds, the slowest device stands for a program
+    series = {}
+    for run_id, program, phase, duration in db.execute("SELECT run_id, program, phase, MAX(duration) FROM phases WHERE skipped = 0 AND failed = 0 GROUP BY run_id, program, phase"):
+        series.setdefault((program, phase), {})[run_id] = duration
+    print("Phase durations in seconds (skipped and failed phases are left out):")
+    print("  {v1} {v2} {v3:>5} {v4:>8} {v5:>8} {v6:>8} {v7:>8}  {v8}".format(v1="program".ljust(16), v2="phase".ljust(22), v3="runs", v4="p50", v5="p95", v6="baseline", v7="last", v8="recent"))
+    regressions = 0
+    for (program, phase), values in sorted(series.items()):
+        durations = list(values.values())
+        baseline = [values[run_id] for run_id in baseline_ids if run_id in values]
+        last = values.get(last_run[0])
+        recent = [values[run_id] for run_id in run_ids[-HISTORY_RECENT_RUNS:] if run_id in values]
+        flag = ""
+        if phase in HISTORY_REGRESSION_PHASES and last is not None and len(baseline) > 0:
+            baseline_median = percentile(baseline, 50)
+            if last > baseline_median * HISTORY_TIME_FACTOR and last - baseline_median > HISTORY_TIME_MIN_DELTA:
+                flag = "  REGRESSION"
+                regressions += 1
+        print("  {v1} {v2} {v3:>5} {v4:>8.2f} {v5:>8.2f} {v6:>8} {v7:>8}  {v8}{v9}".format(
+            v1=(program or "-").ljust(16), v2=phase.ljust(22), v3=len(durations), v4=percentile(durations, 50), v5=percentile(durations, 95),
+            v6="{:.2f}".format(percentile(baseline, 50)) if len(baseline) > 0 else "-", v7="{:.2f}".format(last) if last is not None else "-",
+            v8=" ".join("{:.1f}".format(d) for d in recent), v9=flag))
+
+    sizes = {}
+    for run_id, program, image_size in db.execute("SELECT run_id, program, image_size FROM builds"):
+        sizes.setdefault(program, {})[run_id] = image_size
+    if len(sizes) > 0:
+        print("Image sizes in bytes:")
+    for program, values in sorted(sizes.items()):
+        baseline = [values[run_id] for run_id in baseline_ids if run_id in values]
+        last = values.get(last_run[0])
+        flag = ""
+        if last is not None and len(baseline) > 0 and last > percentile(baseline, 50) * HISTORY_SIZE_FACTOR:
+            flag = "  REGRESSION"
+            regressions += 1
+        print("  {v1} last {v2}, baseline {v3}{v4}".format(v1=program.ljust(16), v2=last if last is not None else "-", v3=percentile(baseline, 50) if len(baseline) > 0 else "-", v4=flag))
+
+    last_builds = db.execute("SELECT program, ccache_hits, ccache_misses, artifact_cache_hit FROM builds WHERE run_id = ?", (last_run[0],)).fetchall()
+    if len(last_builds) > 0:
+        print("Caches in the last run:")
+    for program, hits, misses, artifact_cache_hit in sorted(last_builds):
+        result = []
+        if artifact_cache_hit is not None:
+            result.append("artifact cache {}".format("hit" if artifact_cache_hit else "miss"))
+        if hits is not None:
+            result.append("ccache {v1} hits, {v2} misses".format(v1=hits, v2=misses))
+        print("  {v1} {v2}".format(v1=program.ljust(16), v2=", ".join(result) or "-"))
+
+    flash_counts = db.execute("SELECT device, SUM(status = 'ok'), SUM(status = 'skipped'), SUM(status = 'failed') FROM flashes GROUP BY device ORDER BY device").fetchall()
+    if len(flash_counts) > 0:
+        print("Flash results over all runs:")
+    for device, ok, skipped, failed in flash_counts:
+        print("  {v1} {v2} ok, {v3} skipped, {v4} failed".format(v1=device.ljust(16), v2=ok, v3=skipped, v4=failed))
+    db.close()
+    if regressions > 0:
+        print("{v1} regression(s) against the median of the previous {v2} run(s).".format(v1=regressions, v2=len(baseline_ids)))
+
 def err(text):
     print(text)
     sys.exit(1)
 
-def run_shell_split(args, sudo=False, root_pw=''):
+def run_shell_split(args, sudo=False, root_pw='', env=None, pass_fds=()):
     print(" ".join(args))
-    if not sudo:
-        res = subprocess.run(args, stdout=subprocess.PIPE)
-    else:
-        root_pw_fix = root_pw + "\n"
-        args_fix = ["sudo", "-S"] + args
-        res = subprocess.run(args_fix, input=root_pw_fix.encode(), stdout=subprocess.PIPE)
+    #"picotool load", "cmake", "make": the tool and its subcommand, if any
+    span_name = args[0]
+    if len(args) > 1 and not args[1].startswith("-") and "/" not in args[1]:
+        span_name += " " + args[1]
+    with TraceSpan(span_name, category="shell", command=" ".join(args)) as span:
+        if not sudo:
+            res = subprocess.run(args, stdout=subprocess.PIPE, env=env, pass_fds=pass_fds)
+        else:
+            root_pw_fix = root_pw + "\n"
+            args_fix = ["sudo", "-S"] + args
+            res = subprocess.run(args_fix, input=root_pw_fix.encode(), stdout=subprocess.PIPE, env=env, pass_fds=pass_fds)
+        span.attrs["return_code"] = res.returncode
     return_code = res.returncode
     #shell_output = res.stdout.decode('utf-8')
     if res.returncode != 0:
         err("Shell command '{v1}' exited with code '{v2}'".format(v1=" ".join(args), v2=return_code))
 
-def run_shell(shell_str, sudo=False, root_pw=''):
-    run_shell_split(shell_str.split(), sudo=sudo, root_pw=root_pw)
+def run_shell(shell_str, sudo=False, root_pw='', env=None, pass_fds=()):
+    run_shell_split(shell_str.split(), sudo=sudo, root_pw=root_pw, env=env, pass_fds=pass_fds)
+
+def read_sysfs_attr(path, name):
+    try:
+        with open("{v1}/{v2}".format(v1=path, v2=name), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+def scan_usb_devices():
+    # Raspberry Pi USB devices currently enumerated, None if sysfs is not available
+    try:
+        entries = os.listdir(SYSFS_USB_PATH)
+    except OSError:
+        return None
+    devices = []
+    for entry in entries:
+        #skip interfaces (1-2:1.0) and root hubs (usb1)
+        if ":" in entry or entry.startswith("usb"):
+            continue
+        path = "{v1}/{v2}".format(v1=SYSFS_USB_PATH, v2=entry)
+        if read_sysfs_attr(path, "idVendor") != RPI_VENDOR_ID:
+            continue
+        devices.append({
+            "port": entry,
+            "product": read_sysfs_attr(path, "idProduct"),
+            "serial": read_sysfs_attr(path, "serial").upper(),
+            "tty": find_usb_tty(entry)})
+    return devices
+
+def usb_topology(port):
+    # (root bus, parent hub) of a sysfs port name such as 1-1.4, devices on a root port hang off the root hub usb<bus>
+    bus = port.split("-")[0]
+    if "." in port:
+        return bus, port.rsplit(".", 1)[0]
+    return bus, "usb{}".format(bus)
+
+def find_usb_tty(port):
+    # CDC tty node of a device, interfaces are listed as <port>:<config>.<interface>
+    for entry in sorted(os.listdir(SYSFS_USB_PATH)):
+        if not entry.startswith(port + ":"):
+            continue
+        try:
+            ttys = os.listdir("{v1}/{v2}/tty".format(v1=SYSFS_USB_PATH, v2=entry))
+        except OSError:
+            continue
+        if len(ttys) > 0:
+            return ttys[0]
+    return ""
+
+def snapshot_devices():
+    # serial -> Raspberry Pi USB device from a single sysfs scan, None if sysfs is not available
+    devices = scan_usb_devices()
+    if devices is None:
+        return None
+    return {d["serial"]: d for d in devices if d["serial"] != ""}
+
+def wait_bootsel(serial, timeout, use_sysfs):
+    # Returns once the device re-enumerates in BOOTSEL mode or the timeout expires.
+    # sysfs is watched when the device was visible there before the reboot,
+    # otherwise 'picotool info' is polled until it finds the device.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if use_sysfs:
+            devices = scan_usb_devices() or []
+            if any(d["serial"] == serial and d["product"] in BOOTSEL_PRODUCT_IDS for d in devices):
+                return True
+            time.sleep(USB_POLL_INTERVAL)
+        else:
+            res = subprocess.run(["sudo", "-S", "picotool", "info", "--ser", serial], input=(config["root_pw"] + "\n").encode(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if res.returncode == 0:
+                return True
+            time.sleep(PICOTOOL_POLL_INTERVAL)
+    return False
+
+def find_app_device(serial):
+    devices = scan_usb_devices() or []
+    return next((d for d in devices if d["serial"] == serial and d["product"] not in BOOTSEL_PRODUCT_IDS), None)
+
+def wait_ready_marker(tty_name, marker, deadline):
+    # Reads the device's USB stdio until a line matches 'marker'.
+    # Returns None if the tty can't be opened, so the caller can settle for enumeration.
+    try:
+        fd = os.open("{v1}/{v2}".format(v1=DEV_PATH, v2=tty_name), os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+    except OSError as e:
+        print("Failed to open {v1}: {v2}".format(v1=tty_name, v2=e))
+        return None
+    try:
+        tty.setraw(fd)
+    except termios.error:
+        pass
+    pattern = re.compile(marker)
+    line = ""
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if len(readable) == 0:
+                continue
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                #device went away, e.g. rebooted once more
+                return False
+            if len(data) == 0:
+                return False
+            line += data.decode('utf-8', errors='replace')
+            lines = line.split("\n")
+            line = lines[-1]
+            for text in lines:
+                if pattern.search(text):
+                    return True
+    finally:
+        os.close(fd)
+
+def wait_app_ready(serial, marker, timeout, use_sysfs):
+    # Returns once the flashed device runs its application: it printed 'marker'
+    # or, without a marker, re-enumerated in application mode.
+    # Without sysfs there is nothing to watch, so the full timeout is slept.
+    if not use_sysfs:
+        time.sleep(timeout)
+        return True
+    deadline = time.monotonic() + timeout
+    device = find_app_device(serial)
+    while device is None or (marker != "" and device["tty"] == ""):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(USB_POLL_INTERVAL)
+        device = find_app_device(serial)
+    if marker == "":
+        return True
+    ready = wait_ready_marker(device["tty"], marker, deadline)
+    if ready is None:
+        #the device has already re-enumerated, that is the best we can tell
+        return True
+    return ready
+
+def shell_output(args):
+    # first line printed by a command, "" if it is missing or fails
+    try:
+        res = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return ""
+    if res.returncode != 0:
+        return ""
+    return res.stdout.decode('utf-8', errors='replace').strip().split("\n")[0]
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cmake_files_fingerprint(src_path, skip_path):
+    # CMake inputs of a source tree, skip_path keeps a build directory inside it (CMakeFiles/**/*.cmake) out
+    fingerprint = {}
+    for root, dirs, files in os.walk(src_path):
+        dirs[:] = sorted(d for d in dirs if not path_under(os.path.join(root, d), skip_path))
+        for f in sorted(files):
+            if f == "CMakeLists.txt" or f.endswith(".cmake"):
+                path = os.path.join(root, f)
+                fingerprint[os.path.relpath(path, src_path)] = hash_file(path)
+    return fingerprint
+
+def read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def write_json(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(data, indent=1, sort_keys=True))
+    os.replace(tmp_path, path)
+
+def hash_tree(path, skip_path):
+    # content hash of a source tree, hidden entries (.git, editor files), skip_path (a build
+    # directory inside the sources) and anything but regular files (e.g. fifos) are ignored
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and not path_under(os.path.join(root, d), skip_path))
+        for f in sorted(files):
+            if f.startswith("."):
+                continue
+            file_path = os.path.join(root, f)
+            if not os.path.isfile(file_path):
+                continue
+            h.update("{v1}\0{v2}\0".format(v1=os.path.relpath(file_path, path), v2=hash_file(file_path)).encode())
+    return h.hexdigest()
+
+def same_content(path_1, path_2):
+    if not os.path.isfile(path_1) or not os.path.isfile(path_2):
+        return False
+    if os.path.samefile(path_1, path_2):
+        return True
+    return os.path.getsize(path_1) == os.path.getsize(path_2) and hash_file(path_1) == hash_file(path_2)
+
+def install_artifact(src, dst, link=False, relink=False):
+    # dst is only touched when its content differs, or with 'relink' when it is an equal
+    # copy instead of a hardlink of src. The new file is created next to it and renamed
+    # over it, so dst is always either the old or the new file.
+    if same_content(src, dst) and not (relink and not os.path.samefile(src, dst)):
+        print("{} is up to date".format(dst))
+        return
+    tmp_path = "{v1}.tmp-{v2}".format(v1=dst, v2=uuid.uuid4().hex)
+    linked = False
+    if link:
+        try:
+            os.link(src, tmp_path)
+            linked = True
+            print("ln {v1} {v2}".format(v1=src, v2=dst))
+        except OSError:
+            #cache on another filesystem
+            pass
+    if not linked:
+        print("cp {v1} {v2}".format(v1=src, v2=dst))
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+def prune_stale_files(dir_path, keep):
+    # removes files of programs which are no longer configured and leftovers of interrupted runs
+    if not os.path.isdir(dir_path):
+        return
+    for f in sorted(os.listdir(dir_path)):
+        path = "{v1}/{v2}".format(v1=dir_path, v2=f)
+        if os.path.isfile(path) and f not in keep:
+            print("rm {}".format(path))
+            os.remove(path)
+
+def artifact_cache_entry(cache_path, key):
+    return "{v1}/{v2}/{v3}".format(v1=cache_path, v2=key[:2], v3=key)
+
+def artifact_cache_lookup(cache_path, key):
+    entry_path = artifact_cache_entry(cache_path, key)
+    if not os.path.isfile("{}/image.uf2".format(entry_path)) or not os.path.isfile("{}/image.elf".format(entry_path)):
+        return None
+    #entry mtime is the LRU clock
+    try:
+        os.utime(entry_path)
+    except OSError:
+        return None
+    return entry_path
+
+def artifact_cache_store(cache_path, key, uf2_path, elf_path):
+    entry_path = artifact_cache_entry(cache_path, key)
+    if os.path.isdir(entry_path):
+        return
+    #fill a private directory and rename it into place, so readers never see a partial entry
+    tmp_path = "{v1}/tmp-{v2}".format(v1=cache_path, v2=uuid.uuid4().hex)
+    os.makedirs(tmp_path)
+    shutil.copyfile(uf2_path, "{}/image.uf2".format(tmp_path))
+    shutil.copyfile(elf_path, "{}/image.elf".format(tmp_path))
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+    try:
+        os.rename(tmp_path, entry_path)
+    except OSError:
+        #stored concurrently by another run
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def artifact_cache_evict(cache_path, max_bytes):
+    # drops least recently used entries until the cache fits into max_bytes
+    entries = []
+    total = 0
+    for prefix in os.listdir(cache_path):
+        prefix_path = "{v1}/{v2}".format(v1=cache_path, v2=prefix)
+        if len(prefix) != 2 or not os.path.isdir(prefix_path):
+            continue
+        for key in os.listdir(prefix_path):
+            entry_path = "{v1}/{v2}".format(v1=prefix_path, v2=key)
+            try:
+                size = sum(os.path.getsize("{v1}/{v2}".format(v1=entry_path, v2=f)) for f in os.listdir(entry_path))
+                entries.append((os.path.getmtime(entry_path), size, entry_path))
+            except OSError:
+                continue
+            total += size
+    for mtime, size, entry_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry_path, ignore_errors=True)
+        total -= size
+
+def read_ccache_stats(stats_log_path):
+    # (hits, misses) counted from a ccache (4.0+) stats log, one counter name per line
+    hits = 0
+    misses = 0
+    try:
+        with open(stats_log_path, 'r') as f:
+            for line in f:
+                counter = line.strip()
+                if counter in CCACHE_HIT_COUNTERS:
+                    hits += 1
+                elif counter in CCACHE_MISS_COUNTERS:
+                    misses += 1
+    except OSError:
+        pass
+    return hits, misses
+
+class Jobserver:
+    # GNU make jobserver shared by concurrent builds: a fifo preloaded with one
+    # token per job slot. make joins it through the inherited fd, ninja (1.13+)
+    # through the fifo path. A client also owns one implicit slot, so run() holds
+    # a token for it while the command is running and the total never exceeds 'slots'.
+    # The fifo lives in a private temporary directory, away from the build and source trees.
+    def __init__(self, slots):
+        self.slots = slots
+        self.fifo_dir = tempfile.mkdtemp(prefix="jobserver-")
+        self.fifo_path = "{}/jobserver.fifo".format(self.fifo_dir)
+        os.mkfifo(self.fifo_path)
+        self.fd = os.open(self.fifo_path, os.O_RDWR)
+        os.write(self.fd, b"+" * slots)
+
+    def env(self, base_env=None):
+        env = (base_env or os.environ).copy()
+        if config["generator"] == "ninja":
+            env["MAKEFLAGS"] = "-j{v1} --jobserver-auth=fifo:{v2}".format(v1=self.slots, v2=self.fifo_path)
+        else:
+            env["MAKEFLAGS"] = "-j{v1} --jobserver-auth={v2},{v2}".format(v1=self.slots, v2=self.fd)
+        return env
+
+    def run(self, shell_str, tokens=1, env=None):
+        # 'tokens' > 1 reserves slots for a tool which can't join the jobserver and runs with -j tokens
+        with TraceSpan("wait jobserver", tokens=tokens):
+            for i in range(tokens):
+                os.read(self.fd, 1)
+        try:
+            run_shell(shell_str, env=self.env(env), pass_fds=(self.fd,))
+        finally:
+            os.write(self.fd, b"+" * tokens)
+
+    def close(self):
+        os.close(self.fd)
+        shutil.rmtree(self.fifo_dir, ignore_errors=True)
+
+class SerialLog:
+    # USB stdio of all configured devices, read on one selector thread. Every line
+    # gets the time its chunk was read and the device name, goes into a bounded ring
+    # buffer for the merged view and into BUILD_PATH/logs/<device>.log, which is
+    # rotated at SERIAL_LOG_MAX_BYTES. ttys are reopened when a device re-enumerates,
+    # a device being flashed is left to wait_ready_marker() until resume().
+    # The live view is printed on its own thread, a slow terminal skips lines there
+    # instead of holding up the devices.
+    def __init__(self, devices, log_dir):
+        self.devices = devices #serial -> device name
+        self.log_dir = log_dir
+        self.ring = collections.deque(maxlen=SERIAL_LOG_RING_LINES)
+        self.lock = threading.Lock()
+        self.live = False
+        self.live_queue = queue.Queue(maxsize=SERIAL_LOG_LIVE_CHUNKS)
+        self.live_skipped = 0
+        self.paused = set()
+        self.selector = selectors.DefaultSelector()
+        self.ttys = {} #serial -> (fd, tty name)
+        self.partial = {} #serial -> bytes after the last newline
+        self.files = {} #serial -> (file, size)
+        self.open_errors = set()
+        self.stop_event = threading.Event()
+        os.makedirs(log_dir, exist_ok=True)
+
+    def pause(self, serial):
+        with self.lock:
+            self.paused.add(serial)
+
+    def resume(self, serial):
+        with self.lock:
+            self.paused.discard(serial)
+
+    def set_live(self, live):
+        # the merged view starts with the last lines already captured
+        with self.lock:
+            if live and not self.live:
+                self.show("".join(line + "\n" for line in list(self.ring)[-SERIAL_LOG_TAIL_LINES:]))
+            self.live = live
+
+    def show(self, text):
+        try:
+            self.live_queue.put_nowait(text)
+        except queue.Full:
+            self.live_skipped += text.count("\n")
+
+    def print_live(self):
+        while True:
+            text = self.live_queue.get()
+            if self.live_skipped > 0:
+                text = "... {} lines skipped in the live view\n".format(self.live_skipped) + text
+                self.live_skipped = 0
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    def tail(self, device_names, count):
+        with self.lock:
+            lines = list(self.ring)
+        if len(device_names) > 0:
+            tags = tuple("[{}] ".format(name) for name in device_names)
+            lines = [line for line in lines if line[24:].startswith(tags)]
+        return lines[-count:]
+
+    def open_file(self, serial):
+        log_path = "{v1}/{v2}.log".format(v1=self.log_dir, v2=self.devices[serial])
+        f = open(log_path, "a", buffering=SERIAL_LOG_READ_SIZE)
+        self.files[serial] = (f, f.tell())
+
+    def rotate_file(self, serial):
+        self.files.pop(serial)[0].close()
+        log_path = "{v1}/{v2}.log".format(v1=self.log_dir, v2=self.devices[serial])
+        for i in range(SERIAL_LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists("{v1}.{v2}".format(v1=log_path, v2=i)):
+                os.replace("{v1}.{v2}".format(v1=log_path, v2=i), "{v1}.{v2}".format(v1=log_path, v2=i + 1))
+        os.replace(log_path, "{}.1".format(log_path))
+        self.open_file(serial)
+
+    def add_lines(self, serial, lines):
+        if len(lines) == 0:
+            return
+        now = time.time()
+        prefix = "{v1}.{v2:03d} [{v3}] ".format(v1=time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)), v2=int(now * 1000) % 1000, v3=self.devices[serial])
+        lines = [prefix + line.rstrip(b"\r").decode("utf-8", errors="replace") for line in lines]
+        text = "".join(line + "\n" for line in lines)
+        if serial not in self.files:
+            self.open_file(serial)
+        f, size = self.files[serial]
+        f.write(text)
+        self.files[serial] = (f, size + len(text))
+        if size + len(text) >= SERIAL_LOG_MAX_BYTES:
+            self.rotate_file(serial)
+        with self.lock:
+            self.ring.extend(lines)
+            if self.live:
+                self.show(text)
+
+    def read_device(self, serial):
+        fd = self.ttys[serial][0]
+        try:
+            data = os.read(fd, SERIAL_LOG_READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            #device went away, e.g. rebooted to be flashed
+            data = b""
+        if len(data) == 0:
+            self.close_device(serial)
+            return
+        lines = (self.partial.pop(serial, b"") + data).split(b"\n")
+        #a line without newline is kept for the next read unless it keeps growing
+        if len(lines[-1]) < SERIAL_LOG_READ_SIZE:
+            self.partial[serial] = lines.pop()
+            if len(self.partial[serial]) == 0:
+                del self.partial[serial]
+        self.add_lines(serial, lines)
+
+    def close_device(self, serial):
+        fd, tty_name = self.ttys.pop(serial)
+        self.selector.unregister(fd)
+        os.close(fd)
+        partial = self.partial.pop(serial, b"")
+        if len(partial) > 0:
+            self.add_lines(serial, [partial])
+
+    def open_devices(self):
+        # one sysfs scan for all devices, ttys of new or re-enumerated devices are opened
+        usb_devices = snapshot_devices() or {}
+        with self.lock:
+            paused = set(self.paused)
+        for serial in self.devices:
+            usb_device = usb_devices.get(serial)
+            tty_name = usb_device["tty"] if usb_device is not None else ""
+            if serial in self.ttys:
+                if serial not in paused and self.ttys[serial][1] == tty_name:
+                    continue
+                self.close_device(serial)
+            if serial in paused or tty_name == "":
+                continue
+            try:
+                fd = os.open("{v1}/{v2}".format(v1=DEV_PATH, v2=tty_name), os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+            except OSError as e:
+                #reported once per tty, e.g. when the user is not in the dialout group
+                if (serial, tty_name) not in self.open_errors:
+                    self.open_errors.add((serial, tty_name))
+                    print("Failed to open {v1} for the serial log: {v2}".format(v1=tty_name, v2=e))
+                continue
+            try:
+                #TCSANOW keeps the output which arrived before the tty was opened
+                tty.setraw(fd, termios.TCSANOW)
+            except termios.error:
+                pass
+            self.ttys[serial] = (fd, tty_name)
+            self.selector.register(fd, selectors.EVENT_READ, serial)
+
+    def run(self):
+        next_scan = 0
+        next_flush = time.monotonic() + SERIAL_LOG_FLUSH_INTERVAL
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            if now >= next_scan:
+                self.open_devices()
+                next_scan = now + SERIAL_LOG_RESCAN_INTERVAL
+            if now >= next_flush:
+                for f, size in self.files.values():
+                    f.flush()
+                next_flush = now + SERIAL_LOG_FLUSH_INTERVAL
+            if len(self.ttys) == 0:
+                self.stop_event.wait(max(0, min(next_scan, next_flush) - now))
+                continue
+            for key, events in self.selector.select(timeout=max(0, min(next_scan, next_flush) - now)):
+                self.read_device(key.data)
+        for serial in list(self.ttys):
+            self.close_device(serial)
+        for f, size in self.files.values():
+            f.close()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        threading.Thread(target=self.print_live, daemon=True).start()
+
+    def close(self):
+        # stops capturing and writes out what is still buffered
+        self.stop_event.set()
+        self.thread.join()
+
+def path_under(path, root):
+    return path == root or path.startswith(root.rstrip("/") + "/")
+
+def watched_file(path):
+    #editor swap and backup files don't change a build
+    name = os.path.basename(path)
+    return not (name.startswith(".") or name.endswith("~") or name.endswith(".swp"))
+
+def watch_dirs(root, skip_path):
+    # root and all directories below it, except skip_path which may live inside a source tree
+    dirs = []
+    for dir_path, subdirs, _ in os.walk(root):
+        subdirs[:] = [d for d in subdirs if not d.startswith(".") and not path_under(os.path.join(dir_path, d), skip_path)]
+        dirs.append(dir_path)
+    return dirs
+
+def snapshot_files(roots, files, skip_path):
+    # path -> (mtime, size) of every watched file, used when inotify is not available
+    snapshot = {}
+    paths = list(files)
+    for root in roots:
+        for dir_path in watch_dirs(root, skip_path):
+            try:
+                paths += [os.path.join(dir_path, name) for name in os.listdir(dir_path)]
+            except OSError:
+                continue
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if watched_file(path) and not os.path.isdir(path):
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+def watch_changes(roots, files, skip_path, on_change):
+    # calls on_change with the set of changed paths once a burst of changes has settled, never returns
+    # roots are watched recursively, files through the directory they are in
+    changed = set()
+    libc = ctypes.CDLL(None, use_errno=True)
+    inotify_fd = libc.inotify_init1(os.O_CLOEXEC) if hasattr(libc, "inotify_init1") else -1
+    if inotify_fd < 0:
+        print("NOTICE: inotify is not available, polling for changes every {} second(s).".format(WATCH_POLL_INTERVAL))
+        previous = snapshot_files(roots, files, skip_path)
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL)
+            current = snapshot_files(roots, files, skip_path)
+            diff = set(path for path in set(previous) | set(current) if previous.get(path) != current.get(path))
+            previous = current
+            if len(diff) > 0:
+                changed |= diff
+            elif len(changed) > 0:
+                on_change(changed)
+                changed = set()
+
+    watch_paths = {}
+    def add_watch(dir_path):
+        wd = libc.inotify_add_watch(inotify_fd, os.fsencode(dir_path), WATCH_EVENTS)
+        if wd >= 0:
+            watch_paths[wd] = dir_path
+    for root in roots:
+        for dir_path in watch_dirs(root, skip_path):
+            add_watch(dir_path)
+    for path in files:
+        add_watch(os.path.dirname(path))
+
+    while True:
+        ready = select.select([inotify_fd], [], [], WATCH_DEBOUNCE if len(changed) > 0 else None)[0]
+        if len(ready) == 0:
+            #nothing happened for WATCH_DEBOUNCE seconds, the burst of saves is over
+            on_change(changed)
+            changed = set()
+            continue
+        data = os.read(inotify_fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_len = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + name_len].rstrip(b"\0"))
+            offset += 16 + name_len
+            if mask & IN_Q_OVERFLOW:
+                #events were lost, treat everything as changed
+                changed |= set(roots) | set(files)
+                continue
+            path = os.path.join(watch_paths.get(wd, ""), name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not path_under(path, skip_path):
+                    for dir_path in watch_dirs(path, skip_path):
+                        add_watch(dir_path)
+                changed.add(path)
+            elif watched_file(path):
+                changed.add(path)
+
+def connect_control_socket(socket_path):
+    # connection to a running daemon, None when nothing listens on socket_path
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        return None
+    return client
+
+def send_control_command(socket_path, command):
+    client = connect_control_socket(socket_path)
+    if client is None:
+        err("An error occurred: no daemon is listening on {}.".format(socket_path))
+    with client:
+        client.sendall((command + "\n").encode())
+        reply = b""
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            reply += data
+    reply = reply.decode().rstrip("\n")
+    print(reply)
+    if reply.startswith("An error occurred"):
+        sys.exit(1)
 
 if len(sys.argv) <= 1:
     err("An error occurred: No config path passed.")
@@ -54,9 +979,38 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 config_path = sys.argv[1]
 
 ignore_stdout_warning = False
-if len(sys.argv) >= 3:
-    if sys.argv[2].lower().strip() == "--ignore_stdout_warning":
+force_flash = False
+watch = False
+daemon = False
+ctl_command = None
+trace_path = None
+report = False
+args = sys.argv[2:]
+i = 0
+while i < len(args):
+    arg = args[i].lower().strip()
+    if arg == "--ignore_stdout_warning":
         ignore_stdout_warning = True
+    elif arg == "--force-flash":
+        force_flash = True
+    elif arg == "--watch":
+        watch = True
+    elif arg == "--daemon":
+        daemon = True
+    elif arg == "--ctl":
+        #everything after --ctl is a command for the running daemon
+        ctl_command = " ".join(args[i + 1:]).strip()
+        break
+    elif arg == "--report":
+        report = True
+    elif arg == "--trace":
+        if i + 1 >= len(args):
+            err("An error occurred: --trace needs an output path.")
+        i += 1
+        trace_path = os.path.abspath(args[i])
+    else:
+        err("An error occurred: unknown argument '{}'.".format(arg))
+    i += 1
 
 try:
     with open(config_path, 'r') as file:
@@ -87,6 +1041,32 @@ if "picotool_listen" not in config.keys():
 if "root_pw" not in config.keys():
     err("An error occurred: No 'root_pw' in json structure.")
 
+#optional settings
+if "parallel_build" not in config.keys():
+    config["parallel_build"] = "off"
+if "pipeline" not in config.keys():
+    config["pipeline"] = "off"
+if "serial_log" not in config.keys():
+    config["serial_log"] = "off"
+if "flash_nproc" not in config.keys():
+    config["flash_nproc"] = ""
+if "usb_hub_nproc" not in config.keys():
+    config["usb_hub_nproc"] = ""
+if "usb_bus_nproc" not in config.keys():
+    config["usb_bus_nproc"] = ""
+if "generator" not in config.keys():
+    config["generator"] = "make"
+if "ccache" not in config.keys():
+    config["ccache"] = "off"
+if "ccache_dir" not in config.keys():
+    config["ccache_dir"] = ""
+if "ccache_max_size" not in config.keys():
+    config["ccache_max_size"] = ""
+if "artifact_cache_path" not in config.keys():
+    config["artifact_cache_path"] = ""
+if "artifact_cache_size" not in config.keys():
+    config["artifact_cache_size"] = "1024"
+
 for device in config["devices"]:
     if "name" not in device:
         err("An error occurred: Incorrect device specified, no 'name' found")
@@ -94,14 +1074,22 @@ for device in config["devices"]:
         err("An error occurred: Incorrect device specified, no 'board' found")
     if "serial" not in device:
         err("An error occurred: Incorrect device specified, no 'serial' found")
+    if "tags" not in device:
+        device["tags"] = []
 
 for program in config["programs"]:
     if "name" not in program:
         err("An error occurred: Incorrect program specified, no 'name' found")
     if "build_type" not in program:
         err("An error occurred: Incorrect program specified, no 'build_type' found")
-    if "device_name" not in program:
-        err("An error occurred: Incorrect program specified, no 'device_name' found")
+    if "device_name" not in program and "devices" not in program:
+        err("An error occurred: Incorrect program specified, no 'device_name' or 'devices' found")
+    if "device_name" in program and "devices" in program:
+        err("An error occurred: Incorrect program specified, both 'device_name' and 'devices' found")
+    if "devices" not in program:
+        program["devices"] = [program["device_name"]]
+    if isinstance(program["devices"], str):
+        program["devices"] = [program["devices"]]
     if "src_path" not in program:
         err("An error occurred: Incorrect program specified, no 'src_path' found") 
     if "debug_device_name" not in program:
@@ -116,6 +1104,8 @@ for program in config["programs"]:
         err("An error occurred: Incorrect program specified, no 'gdb_commands_path' found")
     if '-' in program["name"]:
         err("Forbidden symbol '-' in program name")
+    if "ready_marker" not in program:
+        program["ready_marker"] = ""
 
 #convert values to lowercase
 #ingore serial
@@ -123,12 +1113,13 @@ for device in config["devices"]:
     device["name"] = device["name"].lower().strip()
     device["board"] = device["board"].lower().strip()
     device["serial"] = device["serial"].upper().strip()
+    device["tags"] = [tag.lower().strip() for tag in device["tags"]]
 
 #ingore src_path
 for program in config["programs"]:
     program["name"] = program["name"].lower().strip().replace(" ", "_")
     program["build_type"] = program["build_type"].lower().strip()
-    program["device_name"] = program["device_name"].lower().strip()
+    program["devices"] = [selector.lower().strip() for selector in program["devices"]]
     program["debug_device_name"] = program["debug_device_name"].lower().strip()
     program["src_path"] = program["src_path"].strip()
     if program["src_path"][0] != '/':
@@ -138,6 +1129,7 @@ for program in config["programs"]:
     program["tcl_port"] = program["tcl_port"].strip()
     program["telnet_port"] = program["telnet_port"].strip()
     program["gdb_commands_path"] = program["gdb_commands_path"].strip()
+    program["ready_marker"] = program["ready_marker"].strip()
     if program["gdb_commands_path"][0] != '/':
         program["gdb_commands_path"] = "{v1}/{v2}".format(v1=script_dir, v2=program["gdb_commands_path"])
 
@@ -152,6 +1144,22 @@ if config["pico_sdk_path"][0] != '/':
 config["openocd_output"] = config["openocd_output"].lower().strip()
 config["picotool_listen"] = config["picotool_listen"].lower().strip()
 config["root_pw"] = config["root_pw"].strip()
+config["parallel_build"] = config["parallel_build"].lower().strip()
+config["pipeline"] = config["pipeline"].lower().strip()
+config["serial_log"] = config["serial_log"].lower().strip()
+config["flash_nproc"] = config["flash_nproc"].strip()
+config["generator"] = config["generator"].lower().strip()
+config["ccache"] = config["ccache"].lower().strip()
+config["ccache_dir"] = os.path.expanduser(config["ccache_dir"].strip())
+if config["ccache_dir"] != "" and config["ccache_dir"][0] != '/':
+    config["ccache_dir"] = "{v1}/{v2}".format(v1=script_dir, v2=config["ccache_dir"])
+config["ccache_max_size"] = config["ccache_max_size"].strip()
+config["artifact_cache_path"] = os.path.expanduser(config["artifact_cache_path"].strip())
+if config["artifact_cache_path"] != "":
+    if config["artifact_cache_path"][0] != '/':
+        config["artifact_cache_path"] = "{v1}/{v2}".format(v1=script_dir, v2=config["artifact_cache_path"])
+    config["artifact_cache_path"] = config["artifact_cache_path"].rstrip('/')
+config["artifact_cache_size"] = config["artifact_cache_size"].strip()
 
 #check for duplicates
 DEVICE_NAMES = set()
@@ -192,20 +1200,72 @@ for device in config["devices"]:
 for program in config["programs"]:
     if program["build_type"] not in BUILD_TYPES:
         err("An error occurred: incorrect board type '{}' found.".format(program["build_type"]))
-    if program["device_name"] not in DEVICE_NAMES:
-        err("An error occurred: device name '{}' is not specified.".format(program["device_name"]))
+    #a device group is either a list of device names or "tag:<tag>" selectors
+    device_names = []
+    for selector in program["devices"]:
+        if selector.startswith("tag:"):
+            selected = [d["name"] for d in config["devices"] if selector[4:] in d["tags"]]
+            if len(selected) == 0:
+                err("An error occurred: no device has tag '{}'.".format(selector[4:]))
+        else:
+            if selector not in DEVICE_NAMES:
+                err("An error occurred: device name '{}' is not specified.".format(selector))
+            selected = [selector]
+        for device_name in selected:
+            if device_name not in device_names:
+                device_names.append(device_name)
+    if len(device_names) == 0:
+        err("An error occurred: program '{}' has no devices.".format(program["name"]))
+    #one build serves the whole group, so all its devices need the same board
+    boards = set(d["board"] for d in config["devices"] if d["name"] in device_names)
+    if len(boards) > 1:
+        err("An error occurred: devices of program '{}' have different boards.".format(program["name"]))
+    program["device_names"] = device_names
+    program["device_name"] = device_names[0]
+
+#devices are flashed concurrently, so each of them may receive only one image
+TARGET_DEVICE_NAMES = set()
+for program in config["programs"]:
+    for device_name in program["device_names"]:
+        if device_name in TARGET_DEVICE_NAMES:
+            err("An error occurred: device '{}' is targeted by more than one program.".format(device_name))
+        TARGET_DEVICE_NAMES.add(device_name)
     if program["debug_device_name"] not in DEVICE_NAMES and program["debug_device_name"] != "":              
         err("An error occurred: debug device name '{}' is not specified.".format(program["debug_device_name"]))
+    try:
+        re.compile(program["ready_marker"])
+    except re.error as e:
+        err("An error occurred: incorrect ready_marker '{v1}': {v2}".format(v1=program["ready_marker"], v2=e))
 
 if config["behaviour"] not in BEHAVIOUR_TYPES:
     err("An error occurred: incorrect behaviour '{}' found.".format(config["behaviour"]))
 if config["picotool_listen"] not in PICOTOOL_LISTEN:
     err("An error occurred: incorrect picotool_listen parameter '{}' found.".format(config["picotool_listen"]))
+if config["parallel_build"] not in PARALLEL_BUILD:
+    err("An error occurred: incorrect parallel_build parameter '{}' found.".format(config["parallel_build"]))
+if config["pipeline"] not in PIPELINE:
+    err("An error occurred: incorrect pipeline parameter '{}' found.".format(config["pipeline"]))
+if config["serial_log"] not in SERIAL_LOG:
+    err("An error occurred: incorrect serial_log parameter '{}' found.".format(config["serial_log"]))
+if config["generator"] not in GENERATORS:
+    err("An error occurred: incorrect generator '{}' found.".format(config["generator"]))
+if config["ccache"] not in CCACHE:
+    err("An error occurred: incorrect ccache parameter '{}' found.".format(config["ccache"]))
 
 try:
     int(config["build_nproc"])
 except ValueError:
     err("An error occurred: incorrect build_nproc value '" + config["build_nproc"] + "'.".format())
+for key in ("flash_nproc", "usb_hub_nproc", "usb_bus_nproc"):
+    if config[key] != "":
+        try:
+            int(config[key])
+        except ValueError:
+            err("An error occurred: incorrect {v1} value '{v2}'.".format(v1=key, v2=config[key]))
+try:
+    int(config["artifact_cache_size"])
+except ValueError:
+    err("An error occurred: incorrect artifact_cache_size value '{}'.".format(config["artifact_cache_size"]))
 
 behaviour = config["behaviour"]
 if behaviour not in ("run", "build_only"):
@@ -213,7 +1273,7 @@ if behaviour not in ("run", "build_only"):
 if config["gdb_debug"] not in GDB_DEBUG:
     err("An error occurred: incorrect gdb_debug parameter '{}' found.".format(config["gdb_debug"]))
 
-if not ignore_stdout_warning and config["picotool_listen"] == "off" and config["behaviour"] == "run":
+if not ignore_stdout_warning and ctl_command is None and not report and config["picotool_listen"] == "off" and config["behaviour"] == "run":
     while True:
         answer = input("Proceeding will flash devices with regular binaries. You will have to manually flash them with picotool-friendly binaries to use this tool later. Do you want to continue? (y/n): ").strip().lower()
         if answer in ('yes', 'no', 'y', 'n'):
@@ -242,69 +1302,524 @@ if pico_sdk_path_arg[-1] == '/':
 if pico_sdk_path_arg[0] != '/':
     pico_sdk_path_arg = "{v1}/{v2}".format(v1=script_dir, v2=pico_sdk_path_arg)
 
-if do_build:
-    bin_path = "{}/bin".format(build_path)
-    run_shell("mkdir -p {}".format(bin_path))
-    run_shell("rm -r {}".format(bin_path))
-    run_shell("mkdir -p {}".format(bin_path))
+#a daemon started with --daemon listens here, --ctl sends it a command and exits
+control_socket_path = "{}/project.sock".format(build_path)
+if ctl_command is not None:
+    send_control_command(control_socket_path, ctl_command)
+    sys.exit(0)
+#phases, image sizes and flash results of every run are kept here, --report summarizes them
+history_path = "{}/history.sqlite".format(build_path)
+if report:
+    print_history_report(history_path)
+    sys.exit(0)
+if trace_path is not None:
+    #also written when err() stops the run, the trace then shows where it stopped
+    atexit.register(write_trace, trace_path)
+if daemon:
+    running_daemon = connect_control_socket(control_socket_path)
+    if running_daemon is not None:
+        running_daemon.close()
+        err("An error occurred: a daemon is already listening on {}.".format(control_socket_path))
 
-for program in config["programs"]:
+def debug_enabled(program):
+    return program["build_type"] != "release" and program["debug_device_name"] != ""
+
+#serial -> usb device, taken once per flash phase by resolve_devices(), None without sysfs
+device_states = None
+#started after the first flash when serial_log is "on"
+serial_log = None
+
+def resolve_devices(selected_programs):
+    # takes the device snapshot and stops before anything is built or flashed when a device
+    # of the selected programs, or one of their debug probes, is not connected
+    global device_states
+    device_states = snapshot_devices()
+    if device_states is None:
+        return
+    device_names = set()
+    for program in selected_programs:
+        device_names.update(program["device_names"])
+        if do_debug and debug_enabled(program):
+            device_names.add(program["debug_device_name"])
+    missing = ["{v1} ({v2})".format(v1=d["name"], v2=d["serial"]) for d in config["devices"] if d["name"] in device_names and d["serial"] not in device_states]
+    if len(missing) > 0:
+        err("An error occurred: device(s) '{}' not connected.".format("', '".join(missing)))
+
+if do_write:
+    resolve_devices(config["programs"])
+
+def program_build_settings(program):
+    # (board, CMAKE_BUILD_TYPE, STDIO_USB) of a program
     device = next(d for d in config["devices"] if d["name"] == program["device_name"])
-    board_arg = device["board"]
-    stdio_usb_arg = (config["picotool_listen"] == "on")
-    serial = device["serial"]
+    if program["build_type"] == "debug" or do_debug:
+        build_type_arg = "Debug"
+    else:
+        build_type_arg = "Release"
+    return device["board"], build_type_arg, (config["picotool_listen"] == "on")
+
+def prepare_host_tools():
+    # Builds the SDK host tools once per SDK checkout instead of once per build
+    # directory and returns the cmake arguments which point the builds to them.
+    # Only SDK 2.x looks host tools up through find_package().
+    try:
+        with open("{}/pico_sdk_version.cmake".format(pico_sdk_path_arg), 'r') as f:
+            sdk_major_version = re.search(r"set\(PICO_SDK_VERSION_MAJOR (\d+)\)", f.read())
+    except OSError:
+        sdk_major_version = None
+    if sdk_major_version is None or int(sdk_major_version.group(1)) < 2:
+        return ""
+
+    host_tools_key = hashlib.sha256("{v1}\0{v2}".format(v1=pico_sdk_path_arg, v2=sdk_revision).encode()).hexdigest()[:16]
+    host_tools_path = "{v1}/host_tools/{v2}".format(v1=build_path, v2=host_tools_key)
+    pioasm_install_path = "{}/pioasm-install".format(host_tools_path)
+    if not os.path.isfile("{}/pioasm/pioasmConfig.cmake".format(pioasm_install_path)):
+        run_shell("cmake -S {v1}/tools/pioasm -B {v2}/pioasm-build -DCMAKE_INSTALL_PREFIX={v3} -DPIOASM_FLAT_INSTALL=1".format(v1=pico_sdk_path_arg, v2=host_tools_path, v3=pioasm_install_path))
+        run_shell("cmake --build {v1}/pioasm-build --target install -j {v2}".format(v1=host_tools_path, v2=build_nproc))
+    host_tools_args = " -Dpioasm_DIR={}/pioasm".format(pioasm_install_path)
+
+    #picotool installed by 'make install' brings its CMake package, otherwise every build fetches its own
+    picotool_dir = next((d for d in PICOTOOL_CMAKE_DIRS if os.path.isfile("{}/picotoolConfig.cmake".format(d))), "")
+    if picotool_dir != "":
+        host_tools_args += " -Dpicotool_DIR={}".format(picotool_dir)
+    return host_tools_args
+
+def stage_artifacts(programs, uf2_src_path, elf_src_path, link=False):
+    # the first staged file is copied (or linked from the cache), all others are hardlinks
+    # of it, so a group of N boards keeps one image in bin/ instead of N copies
+    staged_uf2_path = None
+    staged_elf_path = None
+    for program in programs:
+        for device in (d for d in config["devices"] if d["name"] in program["device_names"]):
+            uf2_path = "{v1}/{v2}-{v3}.uf2".format(v1=bin_path, v2=program["name"], v3=device["serial"])
+            if staged_uf2_path is None:
+                install_artifact(uf2_src_path, uf2_path, link=link)
+                staged_uf2_path = uf2_path
+            else:
+                install_artifact(staged_uf2_path, uf2_path, link=True, relink=True)
+        elf_path = "{v1}/debug/elf/{v2}.elf".format(v1=bin_path, v2=program["name"])
+        if staged_elf_path is None:
+            install_artifact(elf_src_path, elf_path, link=link)
+            staged_elf_path = elf_path
+        else:
+            install_artifact(staged_elf_path, elf_path, link=True, relink=True)
+
+def build_program(programs, jobserver=None, leader_future=None, ninja_tokens=1):
+    # Builds the first of 'programs' and stages the result for all of them,
+    # they only differ in name and target device. 'ninja_tokens' is the -j share
+    # of a ninja which can't join the jobserver.
+    program = programs[0]
+    board_arg, build_type_arg, stdio_usb_arg = program_build_settings(program)
     program_name = program["name"]
+    trace_context.set({"program": program_name})
 
-    if do_build:
-        program_name = program["name"]
+    make_path = "{v1}/make/{v2}".format(v1=build_path, v2=program_name)
+    run_shell("mkdir -p {}".format(make_path))
+
+    src_path = program["src_path"] 
+
+    run_shell("mkdir -p {}/debug/elf".format(bin_path))
+
+    #identical sources built for the same configuration are taken from the artifact cache
+    cache_key = ""
+    if artifact_cache_path != "":
+        with TraceSpan("artifact cache lookup") as span:
+            cache_key = hashlib.sha256(json.dumps([hash_tree(src_path, build_path), board_arg, build_type_arg, stdio_usb_arg, sdk_revision, toolchain_version]).encode()).hexdigest()
+            entry_path = artifact_cache_lookup(artifact_cache_path, cache_key)
+            span.attrs["hit"] = (entry_path is not None)
+        if entry_path is not None:
+            print("Artifact cache hit for '{v1}' ({v2}), skipping build.".format(v1=program_name, v2=cache_key[:12]))
+            ccache_stats[program_name] = None
+            with TraceSpan("stage", image_size=os.path.getsize("{}/image.uf2".format(entry_path))):
+                stage_artifacts(programs, "{}/image.uf2".format(entry_path), "{}/image.elf".format(entry_path), link=True)
+            return
 
-        make_path = "{v1}/make/{v2}".format(v1=build_path, v2=program_name)
-        run_shell("mkdir -p {}".format(make_path))
+    configure_cmd = "cmake -DPICO_BOARD={v1} -DCMAKE_BUILD_TYPE={v2} -DPICO_SDK_PATH={v3} -DSTDIO_USB={v4} -B {v5} -S {v6}".format(v1=board_arg, v2=build_type_arg, v3=pico_sdk_path_arg, v4=stdio_usb_arg, v5=make_path, v6=src_path)
+    configure_cmd += host_tools_args
+    if config["generator"] == "ninja":
+        configure_cmd += " -G Ninja"
+    if config["ccache"] == "on":
+        configure_cmd += " -DCMAKE_C_COMPILER_LAUNCHER=ccache -DCMAKE_CXX_COMPILER_LAUNCHER=ccache"
 
-        if program["build_type"] == "debug" or do_debug:
-            build_type_arg = "Debug"
+    #cmake refuses to switch the generator of an existing build directory
+    cmake_cache_path = "{}/CMakeCache.txt".format(make_path)
+    if os.path.isfile(cmake_cache_path):
+        with open(cmake_cache_path, 'r') as f:
+            cmake_cache_text = f.read()
+        #a launcher left from a run with ccache "on" would stay in the cache otherwise
+        if config["ccache"] == "off" and "CMAKE_C_COMPILER_LAUNCHER:" in cmake_cache_text:
+            configure_cmd += " -UCMAKE_C_COMPILER_LAUNCHER -UCMAKE_CXX_COMPILER_LAUNCHER"
+        cached_ninja = ("CMAKE_GENERATOR:INTERNAL=Ninja\n" in cmake_cache_text)
+        if cached_ninja != (config["generator"] == "ninja"):
+            print("Generator of '{}' changed, removing its CMake cache.".format(program_name))
+            os.remove(cmake_cache_path)
+            shutil.rmtree("{}/CMakeFiles".format(make_path), ignore_errors=True)
+
+    #cmake is skipped when nothing that affects the configure step changed since the last one
+    fingerprint_path = "{}/configure_fingerprint.json".format(make_path)
+    fingerprint = {
+        "args": configure_cmd,
+        "sdk_revision": sdk_revision,
+        "toolchain_version": toolchain_version,
+        "cmake_files": cmake_files_fingerprint(src_path, build_path)}
+    configured = os.path.isfile(cmake_cache_path)
+    with TraceSpan("configure") as span:
+        if configured and read_json(fingerprint_path) == fingerprint:
+            print("Configure fingerprint of '{}' is unchanged, skipping cmake.".format(program_name))
+            span.attrs["skipped"] = True
         else:
-            build_type_arg = "Release"
-        src_path = program["src_path"] 
+            if os.path.exists(fingerprint_path):
+                os.remove(fingerprint_path)
+            if jobserver is None:
+                run_shell(configure_cmd)
+            else:
+                jobserver.run(configure_cmd)
+            write_json(fingerprint_path, fingerprint)
+    files = [f for f in os.listdir(make_path) if os.path.isfile("{v1}/{v2}".format(v1=make_path, v2=f)) and ".uf2" in f]
+    target_absent = (len(files) == 0)
+    if len(files) > 1:
+        err("Target is unclear: multiple .uf2 files in make directory. Clear the build directory")
 
-        run_shell("cmake -DPICO_BOARD={v1} -DCMAKE_BUILD_TYPE={v2} -DPICO_SDK_PATH={v3} -DSTDIO_USB={v4} -B {v5} -S {v6}".format(v1=board_arg, v2=build_type_arg, v3=pico_sdk_path_arg, v4=stdio_usb_arg, v5=make_path, v6=src_path))
-        files = [f for f in os.listdir(make_path) if os.path.isfile("{v1}/{v2}".format(v1=make_path, v2=f)) and ".uf2" in f]
-        target_absent = (len(files) == 0)
-        if len(files) > 1:
-            err("Target is unclear: multiple .uf2 files in make directory. Clear the build directory")
+    #ccache logs the result of every compilation of this build, which gives per-program statistics
+    build_env = None
+    if config["ccache"] == "on":
+        ccache_stats_log_path = "{}/ccache_stats.log".format(make_path)
+        if os.path.exists(ccache_stats_log_path):
+            os.remove(ccache_stats_log_path)
+        build_env = os.environ.copy()
+        build_env["CCACHE_STATSLOG"] = ccache_stats_log_path
+        #SDK objects of different build directories get identical hashes, so programs of one build configuration share them
+        build_env["CCACHE_BASEDIR"] = build_path
+        build_env["CCACHE_NOHASHDIR"] = "1"
+        if config["ccache_dir"] != "":
+            build_env["CCACHE_DIR"] = config["ccache_dir"]
+        if config["ccache_max_size"] != "":
+            build_env["CCACHE_MAXSIZE"] = config["ccache_max_size"]
 
+    #with a jobserver the job count comes from MAKEFLAGS, an explicit -j would detach the build from it
+    build_tokens = 1
+    if config["generator"] == "ninja":
+        if target_absent:
+            run_shell("ninja -C {} -t clean".format(make_path))
+        build_cmd = "ninja -C {}".format(make_path)
+        if jobserver is None:
+            build_cmd += " -j {}".format(build_nproc)
+        elif not ninja_jobserver:
+            build_tokens = ninja_tokens
+            build_cmd += " -j {}".format(build_tokens)
+    else:
+        build_cmd = "make -C {}".format(make_path)
+        if jobserver is None:
+            build_cmd += " -j {}".format(build_nproc)
         if target_absent:
-            run_shell("make -C {v1} -j {v2} --always-make".format(v1=make_path, v2=build_nproc))
+            build_cmd += " --always-make"
+    #the first program of a build configuration compiles the SDK objects into ccache, the others reuse them
+    if leader_future is not None:
+        with TraceSpan("wait ccache leader"):
+            concurrent.futures.wait([leader_future])
+    with TraceSpan("build") as span:
+        if jobserver is None:
+            run_shell(build_cmd, env=build_env)
         else:
-            run_shell("make -C {v1} -j {v2}".format(v1=make_path, v2=build_nproc))
-
-        files = [f for f in os.listdir(make_path) if os.path.isfile("{v1}/{v2}".format(v1=make_path, v2=f)) and ".uf2" in f]
-        if len(files) > 1:
-            err("Target is unclear: multiple .uf2 files in make directory. Clear the build directory")
-        run_shell("cp {v1}/{v2} {v3}/{v4}-{v5}.uf2".format(v1=make_path, v2=files[0], v3=bin_path, v4=program_name, v5=serial))
-                
-        files = [f for f in os.listdir(make_path) if os.path.isfile("{v1}/{v2}".format(v1=make_path, v2=f)) and ".elf" in f and ".map" not in f]
-        if len(files) > 1:
-            err("Target is unclear: multiple .elf files in make directory. Clear the build directory")
-        run_shell("mkdir -p {}/debug/elf".format(bin_path))
-        run_shell("cp {v1}/{v2} {v3}/debug/elf/{v4}.elf".format(v1=make_path, v2=files[0], v3=bin_path, v4=program_name))
+            jobserver.run(build_cmd, tokens=build_tokens, env=build_env)
+    if config["ccache"] == "on":
+        ccache_stats[program_name] = read_ccache_stats(ccache_stats_log_path)
+        span.attrs["ccache_hits"], span.attrs["ccache_misses"] = ccache_stats[program_name]
+
+    files = [f for f in os.listdir(make_path) if os.path.isfile("{v1}/{v2}".format(v1=make_path, v2=f)) and ".uf2" in f]
+    if len(files) > 1:
+        err("Target is unclear: multiple .uf2 files in make directory. Clear the build directory")
+    uf2_src_path = "{v1}/{v2}".format(v1=make_path, v2=files[0])
+            
+    files = [f for f in os.listdir(make_path) if os.path.isfile("{v1}/{v2}".format(v1=make_path, v2=f)) and ".elf" in f and ".map" not in f]
+    if len(files) > 1:
+        err("Target is unclear: multiple .elf files in make directory. Clear the build directory")
+    elf_src_path = "{v1}/{v2}".format(v1=make_path, v2=files[0])
+    with TraceSpan("stage", image_size=os.path.getsize(uf2_src_path)):
+        stage_artifacts(programs, uf2_src_path, elf_src_path)
+
+    if cache_key != "":
+        artifact_cache_store(artifact_cache_path, cache_key, uf2_src_path, elf_src_path)
+
+if do_build:
+    bin_path = "{}/bin".format(build_path)
+    run_shell("mkdir -p {}".format(bin_path))
+    run_shell("mkdir -p {}/make".format(build_path))
+
+    sdk_revision = shell_output(["git", "-C", pico_sdk_path_arg, "rev-parse", "HEAD"])
+    toolchain_version = shell_output(["arm-none-eabi-gcc", "--version"])
+    atexit.register(record_history, history_path)
+
+    #program name -> (hits, misses), None when the artifact cache made the build unnecessary
+    ccache_stats = {}
+    if config["ccache"] == "on" and shell_output(["ccache", "--version"]) == "":
+        err("An error occurred: ccache is on, but ccache is not found.")
+
+    ninja_jobserver = False
+    if config["generator"] == "ninja":
+        ninja_version = re.match(r"(\d+)\.(\d+)", shell_output(["ninja", "--version"]))
+        if ninja_version is None:
+            err("An error occurred: ninja generator is selected, but ninja is not found.")
+        ninja_jobserver = ((int(ninja_version.group(1)), int(ninja_version.group(2))) >= (1, 13))
+
+    artifact_cache_path = config["artifact_cache_path"]
+    if artifact_cache_path != "" and sdk_revision == "":
+        print("NOTICE: pico_sdk_path is not a git checkout, the artifact cache is not used.")
+        artifact_cache_path = ""
+    if artifact_cache_path != "":
+        run_shell("mkdir -p {}".format(artifact_cache_path))
+
+    host_tools_args = prepare_host_tools()
+
+def plan_builds(selected_programs):
+    # groups the selected programs into distinct builds
+    #programs with the same sources and build settings differ only in the target device, they are built once
+    build_groups = {}
+    for program in selected_programs:
+        build_key = (program["src_path"],) + program_build_settings(program)
+        build_groups.setdefault(build_key, []).append(program)
+    build_groups = list(build_groups.values())
+    if len(build_groups) < len(selected_programs):
+        print("{v1} programs need {v2} distinct build(s).".format(v1=len(selected_programs), v2=len(build_groups)))
+
+    #builds with the same board, build type and STDIO_USB compile the same SDK objects
+    build_config_keys = {}
+    for programs in build_groups:
+        build_config_keys[programs[0]["name"]] = program_build_settings(programs[0])
+    build_config_count = len(set(build_config_keys.values()))
+    if build_config_count < len(build_groups):
+        print("{v1} builds share {v2} build configuration(s).".format(v1=len(build_groups), v2=build_config_count))
+        if config["ccache"] != "on":
+            print("NOTICE: set ccache to 'on' to compile the SDK once per build configuration instead of once per program.")
+    return build_groups
+
+def submit_builds(executor, build_groups, jobserver):
+    # starts all builds at once on the executor, returns (programs, future) pairs
+    ninja_tokens = 1
+    if config["generator"] == "ninja" and not ninja_jobserver:
+        print("NOTICE: ninja older than 1.13 can't join the jobserver, each build gets an equal share of build_nproc.")
+        #shared by the builds submitted now, a watch rebuild of one program gets all of it
+        ninja_tokens = max(1, int(build_nproc) // max(1, len(build_groups)))
+    build_futures = []
+    leader_futures = {}
+    for programs in build_groups:
+        #builds of one build configuration wait for the first of them, which fills ccache with the SDK objects
+        config_key = program_build_settings(programs[0])
+        if config["ccache"] == "on" and config_key in leader_futures:
+            future = executor.submit(build_program, programs, jobserver, leader_futures[config_key], ninja_tokens)
+        else:
+            future = executor.submit(build_program, programs, jobserver, None, ninja_tokens)
+            leader_futures[config_key] = future
+        build_futures.append((programs, future))
+    return build_futures
+
+def build_programs(selected_programs):
+    # builds the selected programs and refreshes bin/, watch mode passes only the programs whose sources changed
+    build_groups = plan_builds(selected_programs)
+    if config["parallel_build"] == "on":
+        #configure and build all programs at once, sharing build_nproc as one job budget
+        jobserver = Jobserver(max(1, int(build_nproc)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(build_groups))) as executor:
+            build_futures = submit_builds(executor, build_groups, jobserver)
+        failed_programs = []
+        for programs, future in build_futures:
+            try:
+                future.result()
+            except SystemExit:
+                #err() has already reported the failing step of this build
+                failed_programs += [program["name"] for program in programs]
+        jobserver.close()
+        if len(failed_programs) > 0:
+            err("An error occurred: build failed for program(s) '{}'.".format("', '".join(failed_programs)))
+    else:
+        for programs in build_groups:
+            build_program(programs)
+    finish_builds(build_groups)
+
+def finish_builds(build_groups):
+    # drops stale files from bin/, trims the artifact cache and reports ccache use
+    #bin/ is updated in place, whatever the current config doesn't produce is dropped
+    bin_files = set()
+    elf_files = set()
+    debug_config_files = set()
+    for program in config["programs"]:
+        for device in (d for d in config["devices"] if d["name"] in program["device_names"]):
+            bin_files.add("{v1}-{v2}.uf2".format(v1=program["name"], v2=device["serial"]))
+        elf_files.add("{}.elf".format(program["name"]))
+        debug_config_files.add("openocd-{}.cfg".format(program["name"]))
+        debug_config_files.add("{}-gdb.txt".format(program["name"]))
+    prune_stale_files(bin_path, bin_files)
+    prune_stale_files("{}/debug/elf".format(bin_path), elf_files)
+    prune_stale_files("{}/debug/config".format(bin_path), debug_config_files)
+
+    if artifact_cache_path != "":
+        artifact_cache_evict(artifact_cache_path, int(config["artifact_cache_size"]) * 1024 * 1024)
+
+    if config["ccache"] == "on":
+        print("ccache summary:")
+        for programs in build_groups:
+            stats = ccache_stats.get(programs[0]["name"])
+            if stats is None:
+                result = "artifact cache hit"
+            elif stats[0] + stats[1] == 0:
+                result = "nothing compiled"
+            else:
+                result = "{v1} hits, {v2} misses, {v3:.0f}% hit rate".format(v1=stats[0], v2=stats[1], v3=100.0 * stats[0] / (stats[0] + stats[1]))
+            print("  {v1} {v2}".format(v1=", ".join(p["name"] for p in programs).ljust(16), v2=result))
+
+def flash_device(uf_path, serial, ready_marker):
+    trace_context.set({"program": os.path.basename(uf_path).split("-")[0], "device": serial})
+    #the serial log lets go of the tty until the application is up again
+    if serial_log is not None:
+        serial_log.pause(serial)
+    try:
+        with TraceSpan("flash") as flash_span:
+            flash_span.attrs["status"] = load_device(uf_path, serial, ready_marker)
+    finally:
+        if serial_log is not None:
+            serial_log.resume(serial)
+    return flash_span.attrs["status"]
+
+def load_device(uf_path, serial, ready_marker):
+    # reboot to BOOTSEL, load and wait for the application, returns "ok", "skipped" or "not ready"
+    image_hash = hash_file(uf_path)
+    with flash_ledger_lock:
+        unchanged = (flash_ledger.get(serial) == image_hash)
+    if unchanged and not force_flash:
+        print("[{v1}] {v2} is already loaded, skipping".format(v1=serial, v2=os.path.basename(uf_path)))
+        return "skipped"
+
+    #until the load succeeds the image on the device is unknown
+    with flash_ledger_lock:
+        flash_ledger.pop(serial, None)
+        write_json(flash_ledger_path, flash_ledger)
+
+    #the device state comes from the snapshot of this flash phase, without sysfs picotool has to find the device
+    usb_device = None
+    if device_states is not None:
+        usb_device = device_states.get(serial)
+        if usb_device is None:
+            err("An error occurred: device '{}' is not connected.".format(serial))
+    use_sysfs = (usb_device is not None)
+    print("[{v1}] Flashing {v2}".format(v1=serial, v2=os.path.basename(uf_path)))
+    slots = acquire_usb_slots(serial, usb_device)
+    try:
+        if use_sysfs and usb_device["product"] in BOOTSEL_PRODUCT_IDS:
+            print("[{}] Device is already in BOOTSEL mode".format(serial))
+        else:
+            with TraceSpan("reboot"):
+                #-u keeps the device in BOOTSEL, without it -f reboots straight back into the application
+                run_shell("picotool reboot -u -f --ser {v1}".format(v1=serial), sudo=True, root_pw=config["root_pw"])
+            with TraceSpan("wait bootsel") as span:
+                span.attrs["ready"] = wait_bootsel(serial, PICO_RELOAD_TIMEOUT, use_sysfs)
+            if not span.attrs["ready"]:
+                print("[{v1}] Device did not show up in BOOTSEL mode within {v2} seconds, trying to load anyway".format(v1=serial, v2=PICO_RELOAD_TIMEOUT))
+        with TraceSpan("load"):
+            #-x starts the application, a device which was in BOOTSEL before the load stays there otherwise
+            run_shell("picotool load {v1} -x --ser {v2} -f".format(v1=uf_path, v2=serial), sudo=True, root_pw=config["root_pw"])
+    finally:
+        for slot in reversed(slots):
+            slot.release()
+    print("[{v1}] Rebooting...".format(v1=serial))
+    if config["picotool_listen"] == "off":
+        #built without STDIO_USB the application never enumerates, there is nothing to wait for
+        print("[{v1}] Done".format(v1=serial))
+        with flash_ledger_lock:
+            flash_ledger[serial] = image_hash
+            write_json(flash_ledger_path, flash_ledger)
+        return "ok"
+    with TraceSpan("wait app ready") as span:
+        span.attrs["ready"] = wait_app_ready(serial, ready_marker, PICOTOOL_LOAD_TIMEOUT, use_sysfs)
+    if not span.attrs["ready"]:
+        #the image is not known to run, the next flash loads it again
+        print("[{v1}] Device did not report ready within {v2} seconds".format(v1=serial, v2=PICOTOOL_LOAD_TIMEOUT))
+        return "not ready"
+    with flash_ledger_lock:
+        flash_ledger[serial] = image_hash
+        write_json(flash_ledger_path, flash_ledger)
+    print("[{v1}] Done".format(v1=serial))
+    return "ok"
 
 if do_write:
-    files = [f for f in os.listdir(bin_path) if os.path.isfile("{v1}/{v2}".format(v1=bin_path, v2=f)) and ".uf2" in f]
-    for f in files:
-        uf_path = "{v1}/{v2}".format(v1=bin_path, v2=f)
-        serial = f.split("-")[-1][:-4]
-        run_shell("picotool reboot --ser {v1} -f".format(v1=serial), sudo=True, root_pw=config["root_pw"])
-        time.sleep(PICO_RELOAD_TIMEOUT)
-        run_shell("picotool load {v1} --ser {v2} -f".format(v1=uf_path, v2=serial), sudo=True, root_pw=config["root_pw"])
-
-#wait for picos to reboot
-print("Rebooting...")
-time.sleep(PICOTOOL_LOAD_TIMEOUT)
+    #serial -> hash of the last image loaded successfully, kept across runs
+    flash_ledger_path = "{}/flash_ledger.json".format(build_path)
+    flash_ledger = read_json(flash_ledger_path) or {}
+    flash_ledger_lock = threading.Lock()
+    #("bus" or "hub", sysfs name) -> semaphore bounding the reboot/load operations behind it
+    usb_slots = {}
+    usb_slots_lock = threading.Lock()
+
+def acquire_usb_slots(serial, usb_device):
+    # waits for a free slot on the root bus and on the hub of a device, returns the acquired semaphores
+    # without sysfs or without configured limits only flash_nproc applies
+    if usb_device is None:
+        return []
+    slots = []
+    for kind, name in zip(("bus", "hub"), usb_topology(usb_device["port"])):
+        limit = config["usb_{}_nproc".format(kind)]
+        if limit == "":
+            continue
+        with usb_slots_lock:
+            slot = usb_slots.setdefault((kind, name), threading.BoundedSemaphore(max(1, int(limit))))
+        if not slot.acquire(blocking=False):
+            print("[{v1}] Waiting for a free slot on USB {v2} {v3}".format(v1=serial, v2=kind, v3=name))
+            with TraceSpan("wait usb slot", usb="{v1} {v2}".format(v1=kind, v2=name)):
+                slot.acquire()
+        slots.append(slot)
+    return slots
+
+def flash_programs(selected_programs):
+    # loads the staged images of the selected programs onto their devices
+    resolve_devices(selected_programs)
+    program_names = set(p["name"] for p in selected_programs)
+    files = [f for f in os.listdir(bin_path) if os.path.isfile("{v1}/{v2}".format(v1=bin_path, v2=f)) and ".uf2" in f and f.split("-")[0] in program_names]
+    flash_nproc = len(files)
+    if config["flash_nproc"] != "":
+        flash_nproc = int(config["flash_nproc"])
+    #every device goes through reboot, wait and load on its own, a failure does not stop the others
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, flash_nproc)) as executor:
+        flash_futures = []
+        for f in files:
+            uf_path = "{v1}/{v2}".format(v1=bin_path, v2=f)
+            serial = f.split("-")[-1][:-4]
+            program = next(p for p in config["programs"] if p["name"] == f.split("-")[0])
+            flash_futures.append((serial, f, executor.submit(flash_device, uf_path, serial, program["ready_marker"])))
+    flash_results = []
+    for serial, f, future in flash_futures:
+        try:
+            status = future.result()
+        except SystemExit:
+            #err() has already reported the failing picotool call
+            status = "failed"
+        flash_results.append((serial, f, status))
+    failed_serials = report_flash_results(flash_results)
+    if len(failed_serials) > 0:
+        err("An error occurred: flashing failed for device(s) '{}'.".format("', '".join(failed_serials)))
+
+def report_flash_results(flash_results):
+    # prints the flash summary of (serial, file name, status) entries and returns the serials that failed
+    failed_serials = []
+    program_statuses = {}
+    print("Flash summary:")
+    for serial, f, status in flash_results:
+        #a device which did not come up after the load counts as failed
+        if status in ("failed", "not ready"):
+            failed_serials.append(serial)
+        device_name = next((d["name"] for d in config["devices"] if d["serial"] == serial), "")
+        print("  {v1} {v2} {v3} {v4}".format(v1=device_name.ljust(16), v2=serial.ljust(16), v3=f.ljust(32), v4=status))
+        program_statuses.setdefault(f.split("-")[0], []).append(status)
+    for program_name, results in program_statuses.items():
+        if len(results) > 1:
+            counts = ", ".join("{v1} {v2}".format(v1=results.count(status), v2=status) for status in ("ok", "skipped", "not ready", "failed") if status in results)
+            print("  {v1}: {v2} devices, {v3}".format(v1=program_name, v2=len(results), v3=counts))
+    return failed_serials
 
 ocd_tasks = []
 gdb_tasks = []
 gdb_tasks_ports = []
+#program name -> its OpenOCD/GDB session, so that watch mode can restart a single one
+debug_sessions = {}
+#the pipeline starts the sessions of several programs at once
+debug_tasks_lock = threading.Lock()
 if do_debug: 
     openocd_startup_commands = []
     gdb_startup_commands = []
@@ -321,7 +1836,11 @@ if do_debug:
     subprocess.run(["killall", "-9", "gdb"])
 
     enable_openocd_output = (config["openocd_output"] == "on")
-    for program in config["programs"]:
+
+def start_debug(selected_programs):
+    # starts OpenOCD and GDB for the selected programs
+    pending_debug = []
+    for program in selected_programs:
         if program["build_type"] == "release":
             continue
         if program["debug_device_name"] != "":
@@ -385,31 +1904,331 @@ if do_debug:
                 ).format(title="OCD {}".format(program_name), root_pw=config["root_pw"], ocd_cfg_path=openocd_config_path)
 
                 spawn_cmd_1 = ["wezterm", "cli", "spawn", "--", "bash", "-c", openocd_startup]
-                ocd_tasks.append(subprocess.Popen(spawn_cmd_1, env=env))
+                ocd_task = subprocess.Popen(spawn_cmd_1, env=env, stdout=subprocess.PIPE, text=True)
             else:
                 openocd_startup = (
                     "echo '{root_pw}' | sudo -S openocd -f {ocd_cfg_path}"
                 ).format(root_pw=config["root_pw"], ocd_cfg_path=openocd_config_path)
 
                 spawn_cmd_1 = ["bash", "-c", openocd_startup]
-                ocd_tasks.append(subprocess.Popen(spawn_cmd_1, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env))
-            
-            print("Starting OpenOCD...")
-            time.sleep(OPENOCD_INIT_TIMEOUT)            
-    
+                ocd_task = subprocess.Popen(spawn_cmd_1, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+
+            print("Starting OpenOCD for {}...".format(program_name))
+            pending_debug.append({"program_name": program_name, "start_time": time.monotonic(), "ocd_task": ocd_task, "gdb_task": None, "openocd_config_path": openocd_config_path, "gdb_config_path": gdb_config_path, "gdb_port": gdb_port, "tcl_port": tcl_port})
+            with debug_tasks_lock:
+                ocd_tasks.append(ocd_task)
+                debug_sessions[program_name] = pending_debug[-1]
+
+    #all OpenOCD instances start at once, GDB follows each of them as soon as its probe answers
+    deadline = time.monotonic() + OPENOCD_INIT_TIMEOUT
+    while len(pending_debug) > 0:
+        for entry in list(pending_debug):
+            program_name = entry["program_name"]
+            if not enable_openocd_output and entry["ocd_task"].poll() is not None:
+                print("OpenOCD for {} exited, GDB is not started.".format(program_name))
+                record_span("openocd start", "phase", entry["start_time"], time.monotonic(), {"program": program_name, "failed": True})
+                pending_debug.remove(entry)
+                continue
+            ready = openocd_ready(entry["tcl_port"], entry["gdb_port"])
+            if not ready and time.monotonic() < deadline:
+                continue
+            if not ready:
+                print("OpenOCD for {v1} did not answer within {v2} seconds, starting GDB anyway.".format(v1=program_name, v2=OPENOCD_INIT_TIMEOUT))
+            record_span("openocd start", "phase", entry["start_time"], time.monotonic(), {"program": program_name, "ready": ready})
+            pending_debug.remove(entry)
+
             gdb_startup = (
                 "echo -ne '\\033]2;{title}\\007'; "
                 "gdb-multiarch -x {gdb_config_path}; "
                 "exec bash"
-            ).format(title="GDB {}".format(program_name), gdb_config_path=gdb_config_path)
+            ).format(title="GDB {}".format(program_name), gdb_config_path=entry["gdb_config_path"])
             spawn_cmd_2 = ["wezterm", "cli", "spawn", "--", "bash", "-c", gdb_startup]
-            gdb_tasks.append(subprocess.Popen(spawn_cmd_2, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True))
-            gdb_tasks_ports.append(int(gdb_port))
+            gdb_task = subprocess.Popen(spawn_cmd_2, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            entry["gdb_task"] = gdb_task
+            with debug_tasks_lock:
+                gdb_tasks.append(gdb_task)
+                gdb_tasks_ports.append(int(entry["gdb_port"]))
+        if len(pending_debug) > 0:
+            time.sleep(OPENOCD_POLL_INTERVAL)
+
+def wezterm_pane_id(spawn_task):
+    # 'wezterm cli spawn' prints the id of the new pane, None for tasks that didn't go through wezterm
+    if spawn_task is None or spawn_task.args[0] != "wezterm":
+        return None
+    try:
+        pane_id = spawn_task.communicate(timeout=5)[0]
+    except (subprocess.TimeoutExpired, ValueError):
+        return None
+    if pane_id is None or not pane_id.strip().isdigit():
+        return None
+    return pane_id.strip()
+
+def stop_debug(selected_programs):
+    # stops OpenOCD and GDB of the selected programs, the other sessions keep running
+    for program in selected_programs:
+        with debug_tasks_lock:
+            entry = debug_sessions.pop(program["name"], None)
+        if entry is None:
+            continue
+        print("Stopping OpenOCD and GDB for {}...".format(program["name"]))
+        for task in (entry["gdb_task"], entry["ocd_task"]):
+            pane_id = wezterm_pane_id(task)
+            if pane_id is not None:
+                subprocess.run(["wezterm", "cli", "kill-pane", "--pane-id", pane_id])
+        #the brackets keep pkill from matching its own command line
+        subprocess.run(["sudo", "-S", "pkill", "-f", "openoc[d] -f {}".format(entry["openocd_config_path"])], input=(config["root_pw"] + "\n").encode(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        subprocess.run(["pkill", "-f", "gdb-multiarc[h] -x {}".format(entry["gdb_config_path"])], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+async def flash_pipeline_device(program, device, usb_slots, step_executor, flash_results):
+    f = "{v1}-{v2}.uf2".format(v1=program["name"], v2=device["serial"])
+    async with usb_slots:
+        try:
+            status = await asyncio.get_running_loop().run_in_executor(step_executor, flash_device, "{v1}/{v2}".format(v1=bin_path, v2=f), device["serial"], program["ready_marker"])
+        except SystemExit:
+            #err() has already reported the failing picotool call
+            status = "failed"
+    flash_results.append((device["serial"], f, status))
+    return status
+
+async def program_pipeline(programs, build_future, usb_slots, step_executor, flash_results, failed_programs):
+    # build -> flash -> debug of one build group, independent of the other groups
+    try:
+        await asyncio.wrap_future(build_future)
+    except SystemExit:
+        #err() has already reported the failing step of this build
+        failed_programs += [program["name"] for program in programs]
+        return
+    for program in programs:
+        statuses = []
+        if do_write:
+            devices = [d for d in config["devices"] if d["name"] in program["device_names"]]
+            statuses = await asyncio.gather(*(flash_pipeline_device(program, device, usb_slots, step_executor, flash_results) for device in devices))
+        if do_debug and debug_enabled(program) and "failed" not in statuses:
+            await asyncio.get_running_loop().run_in_executor(step_executor, start_debug, [program])
+
+async def run_pipeline(selected_programs):
+    # every build group moves on to flashing and debugging as soon as its own build is done,
+    # the jobserver bounds the compile jobs of all builds and usb_slots the devices flashed at once
+    build_groups = plan_builds(selected_programs)
+    jobserver = Jobserver(max(1, int(build_nproc)))
+    flash_nproc = sum(len(program["device_names"]) for program in selected_programs)
+    if config["flash_nproc"] != "":
+        flash_nproc = int(config["flash_nproc"])
+    usb_slots = asyncio.Semaphore(max(1, flash_nproc))
+    #flashes and debug starts block a thread each, asyncio's default executor would cap them at its own size
+    debug_sessions_count = sum(1 for program in selected_programs if do_debug and debug_enabled(program))
+    step_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, flash_nproc) + debug_sessions_count)
+    flash_results = []
+    failed_programs = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(build_groups))) as executor, step_executor:
+        build_futures = submit_builds(executor, build_groups, jobserver)
+        await asyncio.gather(*(program_pipeline(programs, future, usb_slots, step_executor, flash_results, failed_programs) for programs, future in build_futures))
+    jobserver.close()
+    finish_builds(build_groups)
+    failed_serials = []
+    if do_write:
+        failed_serials = report_flash_results(flash_results)
+    if len(failed_programs) > 0:
+        err("An error occurred: build failed for program(s) '{}'.".format("', '".join(failed_programs)))
+    if len(failed_serials) > 0:
+        err("An error occurred: flashing failed for device(s) '{}'.".format("', '".join(failed_serials)))
+
+if config["pipeline"] == "on":
+    asyncio.run(run_pipeline(config["programs"]))
+else:
+    if do_build:
+        build_programs(config["programs"])
+    if do_write:
+        flash_programs(config["programs"])
+    if do_debug:
+        start_debug(config["programs"])
+#watch rebuilds and control commands are recorded as runs of their own
+record_history(history_path)
+
+def rebuild_changed(paths):
+    # rebuilds and reflashes the programs whose sources changed and restarts their debug sessions
+    paths = [path for path in paths if not path_under(path, build_path)]
+    changed_programs = [p for p in config["programs"] if any(path_under(path, p["src_path"]) for path in paths)]
+    debug_programs = []
+    if do_debug:
+        debug_programs = [p for p in config["programs"] if debug_enabled(p) and (p in changed_programs or p["gdb_commands_path"] in paths)]
+    if len(changed_programs) == 0 and len(debug_programs) == 0:
+        return
+    with session_lock:
+        start_time = time.monotonic()
+        print("Changes detected in program(s) '{}'.".format("', '".join(p["name"] for p in changed_programs + [p for p in debug_programs if p not in changed_programs])))
+        if len(changed_programs) > 0:
+            try:
+                build_programs(changed_programs)
+            except SystemExit:
+                #err() has already reported the failing build, the running images and debug sessions are kept
+                record_history(history_path)
+                print("Watching for changes...")
+                return
+        stop_debug(debug_programs)
+        if do_write and len(changed_programs) > 0:
+            try:
+                flash_programs(changed_programs)
+            except SystemExit:
+                #err() has already reported the failing devices
+                pass
+        try:
+            start_debug(debug_programs)
+        except OSError as e:
+            print("An error occurred: {}".format(e))
+        record_history(history_path)
+        print("Updated in {:.1f} seconds. Watching for changes...".format(time.monotonic() - start_time))
+
+def control_status():
+    # one line per program and per device, for the 'status' command
+    lines = []
+    for program in config["programs"]:
+        debug_state = "off"
+        if program["name"] in debug_sessions:
+            debug_state = "running"
+        elif do_debug and debug_enabled(program):
+            debug_state = "stopped"
+        results = program_results.get(program["name"], {})
+        lines.append("program {v1}: build {v2}, flash {v3}, debug {v4}".format(v1=program["name"], v2=results.get("build", "-"), v3=results.get("flash", "-"), v4=debug_state))
+    usb_devices = scan_usb_devices()
+    for device in config["devices"]:
+        if usb_devices is None:
+            location = "unknown, sysfs is not available"
+        else:
+            usb_device = next((d for d in usb_devices if d["serial"] == device["serial"]), None)
+            if usb_device is None:
+                location = "not connected"
+            else:
+                location = "usb port {v1}{v2}".format(v1=usb_device["port"], v2=", /dev/{}".format(usb_device["tty"]) if usb_device["tty"] else "")
+        lines.append("device {v1} ({v2}): {v3}".format(v1=device["name"], v2=device["serial"], v3=location))
+    if watch:
+        lines.append("watching for changes")
+    return "\n".join(lines)
+
+def control_log(device_names):
+    # last lines of the serial log, of the given devices or of all of them
+    if serial_log is None:
+        return "An error occurred: serial_log is off."
+    for name in device_names:
+        if name not in [d["name"] for d in config["devices"]]:
+            return "An error occurred: device name '{}' is not specified.".format(name)
+    lines = serial_log.tail(device_names, SERIAL_LOG_TAIL_LINES)
+    if len(lines) == 0:
+        return "No serial output captured yet."
+    return "\n".join(lines)
+
+def control_command(line):
+    # runs one command received on the control socket and returns the reply
+    words = line.split()
+    if len(words) == 0:
+        return "An error occurred: empty command."
+    command = words[0].lower()
+    if command not in CONTROL_COMMANDS:
+        return "An error occurred: unknown command '{}'.".format(command)
+    if command == "log":
+        return control_log(words[1:])
+    program_names = [p["name"] for p in config["programs"]]
+    for name in words[1:]:
+        if name not in program_names:
+            return "An error occurred: program name '{}' is not specified.".format(name)
+    selected_programs = [p for p in config["programs"] if len(words) == 1 or p["name"] in words[1:]]
+    if command == "status":
+        return control_status()
+    if command == "stop":
+        control_stop.set()
+        return "Stopping."
+    if command == "flash" and not do_write:
+        return "An error occurred: behaviour is build_only, nothing is flashed."
+    if command == "restart-debug":
+        if not do_debug:
+            return "An error occurred: gdb_debug is off."
+        selected_programs = [p for p in selected_programs if debug_enabled(p)]
+    with session_lock:
+        start_time = time.monotonic()
+        print("Running '{}' from the control socket.".format(line.strip()))
+        try:
+            if command == "build":
+                build_programs(selected_programs)
+            elif command == "flash":
+                flash_programs(selected_programs)
+            else:
+                stop_debug(selected_programs)
+                start_debug(selected_programs)
+        except (SystemExit, OSError) as e:
+            #err() has already reported the failing step in the daemon output
+            if isinstance(e, OSError):
+                print("An error occurred: {}".format(e))
+            for program in selected_programs:
+                program_results.setdefault(program["name"], {})[command] = "failed"
+            return "An error occurred: {} failed for program(s) '{}', see the daemon output.".format(command, "', '".join(p["name"] for p in selected_programs))
+        finally:
+            record_history(history_path)
+        for program in selected_programs:
+            program_results.setdefault(program["name"], {})[command] = "ok"
+    return "{v1} finished for program(s) '{v2}' in {v3:.1f} seconds.".format(v1=command, v2="', '".join(p["name"] for p in selected_programs), v3=time.monotonic() - start_time)
+
+def handle_control_connection(connection):
+    with connection:
+        line = connection.makefile("r").readline()
+        if line == "":
+            #the client closed without a command, e.g. the check for an already running daemon
+            return
+        try:
+            connection.sendall((control_command(line) + "\n").encode())
+        except OSError:
+            #the client is gone, the command has run anyway
+            pass
+
+def serve_control_socket(socket_path):
+    # accepts commands until 'stop', each connection is served on its own thread
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    server.settimeout(0.5)
+    while not control_stop.is_set():
+        try:
+            connection, _ = server.accept()
+        except socket.timeout:
+            continue
+        connection.settimeout(None)
+        threading.Thread(target=handle_control_connection, args=(connection,), daemon=True).start()
+    server.close()
+    os.remove(socket_path)
+
+#program name -> {"build"|"flash"|"restart-debug": "ok"|"failed"}, reported by the 'status' command
+#the first build and flash above stop the script on failure, so reaching this point means they succeeded
+program_results = {}
+for program in config["programs"]:
+    program_results[program["name"]] = {"build": "ok"}
+    if do_write:
+        program_results[program["name"]]["flash"] = "ok"
+#watch mode and control commands never rebuild or reflash at the same time
+session_lock = threading.Lock()
+control_stop = threading.Event()
 
 print("Done.")
 print("NOTICE: before finishing, make sure to clear all breakpoints and resume program execution. If your program is halted at a breakpoint, the board may freeze unless you re-flash or reboot it. In all active GDB prompts, execute 'f' to delete breakpoints and continue.")
-while True:
+if do_write and config["serial_log"] == "on":
+    serial_log = SerialLog({d["serial"]: d["name"] for d in config["devices"]}, "{}/logs".format(build_path))
+    serial_log.start()
+    print("Capturing the serial output of {v1} device(s) in {v2}/logs.".format(v1=len(config["devices"]), v2=build_path))
+    if not daemon:
+        print("Type 'log' or 'l' to show or hide the serial output of all devices.")
+if watch:
+    #rebuilds run on the watcher thread, the prompt below stays responsive
+    watch_roots = sorted(set(p["src_path"] for p in config["programs"]))
+    watch_files = sorted(set(p["gdb_commands_path"] for p in config["programs"])) if do_debug else []
+    threading.Thread(target=watch_changes, args=(watch_roots, watch_files, build_path, rebuild_changed), daemon=True).start()
+    print("Watching {} program(s) for changes...".format(len(config["programs"])))
+if daemon:
+    print("Listening for commands on {}, send 'stop' to finish.".format(control_socket_path))
+    serve_control_socket(control_socket_path)
+while not daemon:
     answer = input("Type 'stop' or 's' to finish\n").strip().lower()
+    if answer in ('log', 'l') and serial_log is not None:
+        serial_log.set_live(not serial_log.live)
     if answer in ('stop', 's'):
 #        for gdb_port in gdb_tasks_ports:
 #            while True:
@@ -427,6 +2246,10 @@ while True:
 #                else:   
 #                    print("Trying again.")
         break
+#let a rebuild in progress finish before the terminals go away
+session_lock.acquire()
+if serial_log is not None:
+    serial_log.close()
 #time.sleep(1)
 subprocess.run(["killall", "-9", "wezterm"])
 subprocess.run(["killall", "-9", "wezterm-gui"])